@@ -26,27 +26,18 @@
 #   an S3 bucket 'eap'.
 # -----------------------------------------------------------------------------
 
-import glob
+import artifact
 import datetime
-import requests
-import sys
-import os
-import time
-import logging
 import json
-import shutil
-import zipfile
-from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWRITE, S_IWGRP, S_IWOTH
-from edl.resources import log
-from edl.resources import state
-from edl.resources import time as xtime
-from edl.resources import web
+import logging
+import os
+import sys
 
 
 # -----------------------------------------------------------------------------
 # Config
 # -----------------------------------------------------------------------------
-def config():
+def config(cwd=None):
     """
     config = {
             "source_dir"    : download .txt files here
@@ -54,7 +45,7 @@ def config():
             "state_file"    : fqpath to file that lists downloaded zip files
             }
     """
-    cwd                     = os.path.abspath(os.path.curdir)
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
     zip_dir                 = os.path.join(cwd, "zip")
     txt_dir                 = os.path.join(cwd, "txt")
     state_file              = os.path.join(zip_dir, "state.txt")
@@ -66,93 +57,179 @@ def config():
     return config
 
 # -----------------------------------------------------------------------------
-# Entrypoint
+# Fast Path
 # -----------------------------------------------------------------------------
-def run(logger, manifest, config):
-    start_date      = datetime.date(*manifest['start_date'])
-    resource_name   = manifest['name']
-    resource_url    = manifest['url']
-    delay           = manifest['download_delay_secs']
+def latest_download(manifest, state_file):
+    """
+    Return the newest day, as 'YYYYMMDD', whose url is listed in state_file,
+    or None if there is none.
+    """
+    (prefix, suffix) = manifest['url'].split('_START_')
+    latest = None
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            for line in f:
+                url = line.strip()
+                if url.startswith(prefix) and url.endswith(suffix):
+                    day = url[len(prefix):len(url) - len(suffix)]
+                    if latest is None or day > latest:
+                        latest = day
+    return latest
+
+def has_pending(manifest, config):
+    """
+    Return True if there may be work to do. Uses only the stdlib, so that a
+    cron invocation with nothing to download exits before importing edl and
+    requests.
+
+    The report for a day is published the following day, so there is work
+    until yesterday's url is listed in the state file. Days missing before
+    the newest download are not retried here: some reports were never
+    published, plan.py fills the others.
+    """
     download_dir    = config['working_dir']
-    txt_dir         = config['source_dir']
     state_file      = config['state_file']
-    # sleep for N seconds in between downloads to meet caiso expected use requirements
-    dates   = xtime.range_pairs(xtime.day_range_to_today(start_date))
-    urls    = list(web.generate_urls(logger, dates, resource_url))
-    log.debug(logger, {
-        "name"      : __name__,
-        "method"    : "run",
-        "resource"  : resource_name,
-        "url"       : resource_url,
-        "delay"     : delay,
-        "download_dir": download_dir,
-        "state_file": state_file,
-        "start_date": str(start_date),
-        "urls_count": len(urls),
-        })
-
-    # download .txt files
-    downloaded_txt_urls = web.download(
-        logger,
-        resource_name,
-        delay,
-        urls,
-        state_file,
-        download_dir,
-        ending='.txt')
+    # leftover .txt files from an interrupted run still need to be zipped
+    if os.path.exists(download_dir) and any(f.endswith('DailyRenewablesWatch.txt') for f in os.listdir(download_dir)):
+        return True
+    latest      = latest_download(manifest, state_file)
+    yesterday   = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y%m%d')
+    return latest is None or latest < yesterday
 
+# -----------------------------------------------------------------------------
+# Downloaded File Helpers
+# -----------------------------------------------------------------------------
+def stage_txt_files(logger, download_dir, txt_dir, overwrite=False, compression=None, names=None):
+    """
+    Copy downloaded .txt files from download_dir to txt_dir, replace them with
+    read-only .zip files, and return the names of the files copied. Existing
+    files in txt_dir are only replaced when overwrite is set. The copies are
+    compressed as requested, see artifact.py. When names is given, only those
+    files are staged and download_dir is not listed.
+    """
+    import glob
+    import zipfile
+    from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWRITE, S_IWGRP, S_IWOTH
+    from edl.resources import log
+    staged = []
     # copy .txt files to ./text dir and then
     # compress original .txt files to .zip files
     if not os.path.exists(txt_dir):
         log.debug(logger, {
             "name"      : __name__,
-            "method"    : "run",
+            "method"    : "stage_txt_files",
             "src"       : "10_down.py",
             "message"   : "created target txt dir: %s" % txt_dir,
             })
         os.makedirs(txt_dir)
 
     # process downloaded .txt files
-    data_files = glob.glob(os.path.join(download_dir, "*DailyRenewablesWatch.txt"))
-    for tf in data_files:
+    if names is None:
+        data_files = glob.glob(os.path.join(download_dir, "*DailyRenewablesWatch.txt"))
+    else:
+        data_files = [os.path.join(download_dir, n) for n in names if os.path.exists(os.path.join(download_dir, n))]
+    for fqtf in data_files:
+        tf = os.path.basename(fqtf)
         try:
             # remove write protections for .txt files
-            os.chmod(os.path.join(download_dir, tf), S_IWRITE|S_IWGRP|S_IWOTH|S_IREAD|S_IRGRP|S_IROTH)
+            os.chmod(fqtf, S_IWRITE|S_IWGRP|S_IWOTH|S_IREAD|S_IRGRP|S_IROTH)
             
             # if the txt file is here, it needs to be copied to the ./txt dir
-            fqtf = os.path.join(download_dir, tf)
             fqtf2 = os.path.join(txt_dir, tf)
             fqtfzip = os.path.join(download_dir, '%s.zip' % tf)
-            if not os.path.exists(fqtf2):
-                shutil.copyfile(fqtf, fqtf2)
+            if overwrite or not artifact.exists(fqtf2):
+                with open(fqtf, 'rb') as f:
+                    artifact.write_bytes(fqtf2, f.read(), compression)
+                staged.append(tf)
+            if os.path.exists(fqtfzip):
+                os.chmod(fqtfzip, S_IWRITE|S_IREAD|S_IRGRP|S_IROTH)
             with zipfile.ZipFile(fqtfzip, 'w') as myzip:
-                myzip.write(fqtfzip)
+                myzip.write(fqtf, arcname=tf)
 
             # set .zip file to be read only
             os.chmod(fqtfzip, S_IREAD|S_IRGRP|S_IROTH)
         
             # remove the zip/.txt file as it's been copied to txt/.txt
-            if os.path.exists(fqtf2) and os.path.exists(fqtfzip):
+            if artifact.exists(fqtf2) and os.path.exists(fqtfzip):
                 os.remove(fqtf)
             log.debug(logger, {
                 "name"      : __name__,
-                "method"    : "run",
+                "method"    : "stage_txt_files",
                 "src"       : "10_down.py",
                 "message"   : "zipped file: %s" % tf,
                 })
         except Exception as e:
             log.error(logger, {
                 "name"      : __name__,
-                "method"    : "run",
+                "method"    : "stage_txt_files",
                 "src"       : "10_down.py",
                 "file"      : tf,
                 "error"     : "failed to process file",
                 "exception" : str(e),
                 })
+    return staged
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWRITE, S_IWGRP, S_IWOTH
+    from edl.resources import log
+    from edl.resources import state
+    from edl.resources import time as xtime
+    from edl.resources import web
+    start_date      = datetime.date(*manifest['start_date'])
+    resource_name   = manifest['name']
+    resource_url    = manifest['url']
+    delay           = manifest['download_delay_secs']
+    download_dir    = config['working_dir']
+    txt_dir         = config['source_dir']
+    state_file      = config['state_file']
+    # sleep for N seconds in between downloads to meet caiso expected use requirements
+    dates   = xtime.range_pairs(xtime.day_range_to_today(start_date))
+    urls    = list(web.generate_urls(logger, dates, resource_url))
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "url"       : resource_url,
+        "delay"     : delay,
+        "download_dir": download_dir,
+        "state_file": state_file,
+        "start_date": str(start_date),
+        "urls_count": len(urls),
+        })
+
+    # download .txt files
+    throttle = config.get('throttle')
+    if throttle is None:
+        downloaded_txt_urls = web.download(
+            logger,
+            resource_name,
+            delay,
+            urls,
+            state_file,
+            download_dir,
+            ending='.txt')
+    else:
+        # a caller-supplied throttle (see orchestrate.py) replaces the per-feed
+        # delay, it is called before each url that still needs downloading
+        downloaded = set()
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                downloaded = set(line.strip() for line in f)
+        downloaded_txt_urls = []
+        for url in urls:
+            if url not in downloaded:
+                throttle(url)
+                downloaded_txt_urls.extend(web.download(logger, resource_name, 0, [url], state_file, download_dir, ending='.txt'))
 
+    stage_txt_files(logger, download_dir, txt_dir, compression=manifest.get('compression'))
 
     # TODO: something is clobbering perms on the state file, so clobber it back
-    os.chmod(os.path.join(download_dir, 'state.txt'), S_IWRITE|S_IWGRP|S_IWOTH|S_IREAD|S_IRGRP|S_IROTH)
+    # (a new feed has no state file until its first url is recorded)
+    if os.path.exists(state_file):
+        os.chmod(state_file, S_IWRITE|S_IWGRP|S_IWOTH|S_IREAD|S_IRGRP|S_IROTH)
     # final step
     state.update(downloaded_txt_urls, state_file)
 # -----------------------------------------------------------------------------
@@ -163,6 +240,12 @@ if __name__ == "__main__":
         loglevel = sys.argv[1]
     else:
         loglevel = "INFO"
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+    c = config()
+    if not has_pending(m, c):
+        sys.exit(0)
+    from edl.resources import log
     log.configure_logging()
     logger = logging.getLogger(__name__)
     logger.setLevel(loglevel)
@@ -171,6 +254,4 @@ if __name__ == "__main__":
         "method"    : "main",
         "src"       : "10_down.py"
         })
-    with open('manifest.json', 'r') as json_file:
-        m = json.load(json_file)
-        run(logger, m, config())
+    run(logger, m, c)
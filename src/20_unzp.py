@@ -20,19 +20,15 @@
 # 20_unzp.py : do nothing, files have already been unzipped in 10_down.py
 # -----------------------------------------------------------------------------
 
-from edl.resources import log
-from edl.resources import state
-from edl.resources import zp
 import json
 import logging
 import os
 import sys
-import zipfile as zf
 
 # -----------------------------------------------------------------------------
 # Config
 # -----------------------------------------------------------------------------
-def config():
+def config(cwd=None):
     """
     config = {
             "source_dir"    : location of zip files
@@ -40,7 +36,7 @@ def config():
             "state_file"    : fqpath to a file that lists unzipped files
             }
     """
-    cwd                     = os.path.abspath(os.path.curdir)
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
     zip_dir                 = os.path.join(cwd, "zip")
     xml_dir                 = os.path.join(cwd, "xml")
     state_file              = os.path.join(xml_dir, "state.txt")
@@ -51,7 +47,15 @@ def config():
             }
     return config
 
-
+# -----------------------------------------------------------------------------
+# Fast Path
+# -----------------------------------------------------------------------------
+def has_pending(manifest, config):
+    """
+    Return True if there may be work to do. This stage never has any, so the
+    cron invocation exits before importing edl.
+    """
+    return False
 
 # -----------------------------------------------------------------------------
 # Entrypoint
@@ -70,6 +74,12 @@ if __name__ == "__main__":
         loglevel = sys.argv[1]
     else:
         loglevel = "INFO"
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+    c = config()
+    if not has_pending(m, c):
+        sys.exit(0)
+    from edl.resources import log
     log.configure_logging()
     logger = logging.getLogger(__name__)
     logger.setLevel(loglevel)
@@ -78,6 +88,4 @@ if __name__ == "__main__":
         "method"    : "main",
         "src"       : "20_unzp.py"
         })
-    with open('manifest.json', 'r') as json_file:
-        m = json.load(json_file)
-        run(logger, m, config())
+    run(logger, m, c)
@@ -21,9 +21,7 @@
 # -----------------------------------------------------------------------------
 
 from datetime import datetime
-from dateutil import parser
-from edl.resources import log
-from edl.resources import state
+import artifact
 import json
 import logging
 import os
@@ -88,11 +86,28 @@ EXAMPLE = """
 	24		1371		1121		12330		5056		2068
 """
 
+# derived per-hour columns, computed at ingest so that queries need neither
+# the solar coalesce nor the renewable/total join:
+#   solar_all       : solar, or solar_pv + solar_thermal in the newer reports,
+#                     NULL if a component is missing (35_vald.py flags those)
+#   total_load      : sum of the total production columns
+#   net_load        : total_load less renewables
+#   renewable_share : renewables / total_load
+# total.solar_all is a deliberate denormalized copy of renewable.solar_all,
+# filled through the UNIQUE(date, hour) index, so that the total table alone
+# answers the usual load/solar queries
+DERIVED_COLUMNS = {
+        'renewable' : [('solar_all', 'INT')],
+        'total'     : [('solar_all', 'INT'), ('total_load', 'INT'), ('net_load', 'INT'), ('renewable_share', 'REAL')],
+        }
+SOLAR_ALL   = 'COALESCE(solar, solar_pv + solar_thermal)'
+TOTAL_LOAD  = '(renewables + nuclear + thermal + imports + hydro)'
+
 
 # -----------------------------------------------------------------------------
 # Config
 # -----------------------------------------------------------------------------
-def config():
+def config(cwd=None):
     """
     config = {
             "source_dir"    : location of the source files
@@ -100,7 +115,7 @@ def config():
             "state_file"    : fqpath to file that lists the inserted source files
             }
     """
-    cwd                     = os.path.abspath(os.path.curdir)
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
     config = {
             "source_dir"    : os.path.join(cwd, "txt"),
             "working_dir"   : os.path.join(cwd, "sql"),
@@ -108,13 +123,27 @@ def config():
             }
     return config
 
+# -----------------------------------------------------------------------------
+# Fast Path
+# -----------------------------------------------------------------------------
+def has_pending(manifest, config):
+    """
+    Return True if there are text files not yet listed in the state file.
+    Uses only the stdlib, so that a cron invocation with nothing to parse
+    exits before importing edl and dateutil.
+    """
+    txt_dir         = config['source_dir']
+    state_file      = config['state_file']
+    return len(artifact.new_files(state_file, txt_dir, 'DailyRenewablesWatch.txt')) > 0
+
 # -----------------------------------------------------------------------------
 # Text File Parser
 # -----------------------------------------------------------------------------
-def parse_text_files(logger, resource_name, new_files, txt_dir, sql_dir):
+def parse_text_files(logger, resource_name, new_files, txt_dir, sql_dir, compression=None):
+    from edl.resources import log
     for f in new_files:
         try:
-            yield parse_text_file(logger, resource_name, txt_dir, sql_dir, f)
+            yield parse_text_file(logger, resource_name, txt_dir, sql_dir, f, compression)
         except Exception as e:
             log.error(logger, {
                 "name"      : __name__,
@@ -126,16 +155,18 @@ def parse_text_files(logger, resource_name, new_files, txt_dir, sql_dir):
                 "exception" : str(e),
                 })
 
-def parse_text_file(logger, resource_name, txt_dir, sql_dir, f):
+def parse_text_file(logger, resource_name, txt_dir, sql_dir, f, compression=None):
+    from edl.resources import log
     input_file = os.path.join(txt_dir, f)
     (dict_renewable, dict_total) = read_file_name(input_file)
     renewable_sql   = gen_renewable_sql(dict_renewable)
     total_sql       = gen_total_sql(dict_total)
+    derived_sql     = gen_derived_sql(dict_renewable['date'])
     (f_name, f_ext) = os.path.splitext(f)
-    output_file = os.path.join(sql_dir, "%s.sql" % f_name)
-    with open(output_file, 'w') as sqlfile:
-        [sqlfile.write("%s\n" % line) for line in renewable_sql]
-        [sqlfile.write("%s\n" % line) for line in total_sql]
+    output_file = artifact.write_text(
+            os.path.join(sql_dir, "%s.sql" % f_name),
+            ''.join("%s\n" % line for line in renewable_sql + total_sql + derived_sql),
+            compression)
     log.debug(logger, {
         "name"      : __name__,
         "method"    : "parse_text_file",
@@ -150,8 +181,7 @@ def parse_text_file(logger, resource_name, txt_dir, sql_dir, f):
 # -----------------------------------------------------------------------------
 
 def read_file_name(name):
-    with open(name, 'r') as f:
-        return read_file(f)
+    return read_data(artifact.read_text(name))
 
 def read_file(fh):
     return read_data(fh.read())
@@ -160,11 +190,13 @@ def chunk(s):
     return s.split("Hourly")
 
 def extract_date(s):
+    from dateutil import parser
     s = s.lstrip().rstrip()
     d = parser.parse(s) 
     return d
 
 def extract_table(date, s):
+    from edl.resources import log
     # first line is header
     # second line is column names
     # remaining 24 lines are data
@@ -205,8 +237,9 @@ def read_data(s):
 
 
 def gen_renewable_sql(t):
+    from edl.resources import log
     #Hour		GEOTHERMAL	BIOMASS		BIOGAS		SMALL HYDRO	WIND TOTAL	SOLAR PV	SOLAR THERMAL						
-    renewable_ddl   = 'CREATE TABLE IF NOT EXISTS renewable (id PRIMARY KEY ASC, date TEXT, hour INT, geothermal INT, biomass INT, biogas INT, small_hydro INT, wind_total INT, solar_pv INT, solar_thermal INT, solar INT, UNIQUE(date, hour));'
+    renewable_ddl   = 'CREATE TABLE IF NOT EXISTS renewable (id PRIMARY KEY ASC, date TEXT, hour INT, geothermal INT, biomass INT, biogas INT, small_hydro INT, wind_total INT, solar_pv INT, solar_thermal INT, solar INT, solar_all INT, UNIQUE(date, hour));'
     res             = [renewable_ddl]
     for idx in range(1,26):
         try:
@@ -239,8 +272,9 @@ def gen_renewable_sql(t):
     return res
 
 def gen_total_sql(t):
+    from edl.resources import log
     #Hour		RENEWABLES	NUCLEAR		THERMAL		IMPORTS		HYDRO							
-    total_ddl       = 'CREATE TABLE IF NOT EXISTS total (id PRIMARY KEY ASC, date TEXT, hour INT, renewables INT, nuclear INT, thermal INT, imports INT, hydro INT, UNIQUE(date, hour));'
+    total_ddl       = 'CREATE TABLE IF NOT EXISTS total (id PRIMARY KEY ASC, date TEXT, hour INT, renewables INT, nuclear INT, thermal INT, imports INT, hydro INT, solar_all INT, total_load INT, net_load INT, renewable_share REAL, UNIQUE(date, hour));'
     res             = [total_ddl]
     for idx in range(1,26):
         try:
@@ -266,6 +300,18 @@ def gen_total_sql(t):
                 })
     return res
 
+def gen_derived_sql(date=None):
+    """
+    Return the UPDATEs that fill the DERIVED_COLUMNS for date, or for every
+    row when date is None (see derive.py).
+    """
+    where = '' if date is None else f' WHERE date = "{date}"'
+    return [
+        f'UPDATE renewable SET solar_all = {SOLAR_ALL}{where};',
+        f'UPDATE total SET total_load = {TOTAL_LOAD}, net_load = {TOTAL_LOAD} - renewables, '
+        f'renewable_share = CAST(renewables AS REAL) / NULLIF({TOTAL_LOAD}, 0), '
+        f'solar_all = (SELECT r.solar_all FROM renewable r WHERE r.date = total.date AND r.hour = total.hour){where};',
+        ]
 
 def int_or_none(v):
     try:
@@ -277,12 +323,15 @@ def int_or_none(v):
 # Entrypoint
 # -----------------------------------------------------------------------------
 def run(logger, manifest, config):
+    from edl.resources import log
+    from edl.resources import state
     resource_name   = manifest['name']
     resource_url    = manifest['url']
+    compression     = manifest.get('compression')
     txt_dir         = config['source_dir']
     sql_dir         = config['working_dir']
     state_file      = config['state_file']
-    new_files = state.new_files(resource_name, state_file, txt_dir, 'DailyRenewablesWatch.txt')
+    new_files = artifact.new_files(state_file, txt_dir, 'DailyRenewablesWatch.txt')
     log.debug(logger, {
         "name"      : __name__,
         "method"    : "run",
@@ -294,7 +343,7 @@ def run(logger, manifest, config):
         "new_files_count" : len(new_files),
         })
     state.update(
-            parse_text_files(logger, resource_name, new_files, txt_dir, sql_dir), 
+            parse_text_files(logger, resource_name, new_files, txt_dir, sql_dir, compression),
             state_file)
 
 # -----------------------------------------------------------------------------
@@ -305,6 +354,12 @@ if __name__ == "__main__":
         loglevel = sys.argv[1]
     else:
         loglevel = "INFO"
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+    c = config()
+    if not has_pending(m, c):
+        sys.exit(0)
+    from edl.resources import log
     log.configure_logging()
     logger = logging.getLogger(__name__)
     logger.setLevel(loglevel)
@@ -313,6 +368,4 @@ if __name__ == "__main__":
         "method"    : "main",
         "src"       : "30_pars.py"
         })
-    with open('manifest.json', 'r') as json_file:
-        m = json.load(json_file)
-        run(logger, m, config())
+    run(logger, m, c)
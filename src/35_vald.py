@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# 35_vald.py : validate parsed sql files before insertion
+#
+# * the new batch of sql files is loaded into an in-memory database attached
+#   to the main database, and every check is a single set-based query over
+#   the whole batch
+# * checks: NULL cells, negative MW, renewable components that do not sum to
+#   RENEWABLES in the total table, duplicate hours (within the batch, and
+#   against different rows the db already holds for that hour, which the
+#   UNIQUE constraint would otherwise drop at insert), hours outside 1..24,
+#   incomplete days (DST aware), and z-score spikes against the preceding
+#   days already in the db
+# * results are written to the 'violation' table of the main database, the
+#   batch itself is left for 40_inse.py to insert
+# -----------------------------------------------------------------------------
+
+import artifact
+import importlib
+import json
+import logging
+import os
+import sys
+
+RENEWABLE_COLUMNS   = ['geothermal', 'biomass', 'biogas', 'small_hydro', 'wind_total', 'solar_pv', 'solar_thermal', 'solar']
+TOTAL_COLUMNS       = ['renewables', 'nuclear', 'thermal', 'imports', 'hydro']
+
+# older reports carry a single solar column, newer ones split pv and thermal;
+# combined the same way as the derived solar_all column
+SOLAR               = importlib.import_module('30_pars').SOLAR_ALL
+RENEWABLE_SUM       = 'geothermal + biomass + biogas + small_hydro + wind_total + %s' % SOLAR
+
+# (table, column name in the violation table, expression) checked for spikes
+SPIKE_SERIES = [('renewable', c, c) for c in RENEWABLE_COLUMNS[:5]] + \
+        [('renewable', 'solar', SOLAR)] + \
+        [('total', c, c) for c in TOTAL_COLUMNS]
+
+VIOLATION_DDL = 'CREATE TABLE IF NOT EXISTS violation (date TEXT, hour INT, tbl TEXT, col TEXT, rule TEXT, value REAL, expected REAL, UNIQUE(date, hour, tbl, col, rule));'
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config(cwd=None):
+    """
+    config = {
+            "source_dir"        : location of the sql files
+            "working_dir"       : location of the database
+            "state_file"        : fqpath to file that lists the validated sql files
+            "sum_tolerance_mw"  : allowed difference between the component sum and RENEWABLES
+            "zscore"            : flag values further than this many std devs from the baseline
+            "baseline_days"     : number of preceding days in the rolling baseline
+            "baseline_min_days" : minimum number of days before the baseline is used
+            }
+    """
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
+    sql_dir                 = os.path.join(cwd, "sql")
+    db_dir                  = os.path.join(cwd, "db")
+    vald_dir                = os.path.join(cwd, "vald")
+    state_file              = os.path.join(vald_dir, "state.txt")
+    config = {
+            "source_dir"        : sql_dir,
+            "working_dir"       : db_dir,
+            "state_file"        : state_file,
+            "sum_tolerance_mw"  : 10,
+            "zscore"            : 4.0,
+            "baseline_days"     : 28,
+            "baseline_min_days" : 7,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Fast Path
+# -----------------------------------------------------------------------------
+def has_pending(manifest, config):
+    """
+    Return True if there are sql files not yet listed in the state file.
+    Uses only the stdlib, so that a cron invocation with nothing to validate
+    exits before importing edl and sqlite3.
+    """
+    sql_dir         = config['source_dir']
+    state_file      = config['state_file']
+    return len(artifact.new_files(state_file, sql_dir, '.sql')) > 0
+
+# -----------------------------------------------------------------------------
+# Batch Loader
+# -----------------------------------------------------------------------------
+def load_batch(logger, conn, sql_dir, new_files):
+    """
+    Load the INSERT statements of new_files into the attached 'batch' schema
+    and return the files that loaded. The batch tables have no UNIQUE
+    constraint, so duplicates are loaded and reported instead of aborting the
+    file.
+    """
+    from edl.resources import log
+    loaded = []
+    conn.execute("CREATE TABLE batch.renewable (date TEXT, hour INT, %s)" % ', '.join('%s INT' % c for c in RENEWABLE_COLUMNS))
+    conn.execute("CREATE TABLE batch.total (date TEXT, hour INT, %s)" % ', '.join('%s INT' % c for c in TOTAL_COLUMNS))
+    for f in new_files:
+        try:
+            lines   = artifact.read_text(os.path.join(sql_dir, f)).split('\n')
+            inserts = [line.replace('INSERT INTO ', 'INSERT INTO batch.', 1)
+                    for line in lines if line.startswith('INSERT INTO ')]
+            conn.executescript('\n'.join(inserts))
+            loaded.append(f)
+        except Exception as e:
+            log.error(logger, {
+                "name"      : __name__,
+                "method"    : "load_batch",
+                "src"       : "35_vald.py",
+                "input"     : os.path.join(sql_dir, f),
+                "exception" : str(e),
+                })
+    return loaded
+
+def expected_hours(day):
+    """
+    Number of hours the report for 'YYYY-MM-DD' should carry. The parser keeps
+    at most 24 rows, so only the spring-forward day is short.
+    """
+    import datetime
+    from zoneinfo import ZoneInfo
+    tz      = ZoneInfo('America/Los_Angeles')
+    d       = datetime.date.fromisoformat(day[:10])
+    start   = datetime.datetime(d.year, d.month, d.day, tzinfo=tz)
+    end     = start + datetime.timedelta(days=1)
+    hours   = (end.astimezone(datetime.timezone.utc) - start.astimezone(datetime.timezone.utc)).total_seconds() // 3600
+    return int(min(hours, 24))
+
+# -----------------------------------------------------------------------------
+# Checks
+# -----------------------------------------------------------------------------
+def check_nulls():
+    sql = []
+    for c in RENEWABLE_COLUMNS[:5]:
+        sql.append("SELECT date, hour, 'renewable', '%s', 'null', NULL, NULL FROM batch.renewable WHERE %s IS NULL" % (c, c))
+    sql.append("SELECT date, hour, 'renewable', 'solar', 'null', NULL, NULL FROM batch.renewable WHERE %s IS NULL" % SOLAR)
+    for c in TOTAL_COLUMNS:
+        sql.append("SELECT date, hour, 'total', '%s', 'null', NULL, NULL FROM batch.total WHERE %s IS NULL" % (c, c))
+    return sql
+
+def check_negatives():
+    sql = []
+    for c in RENEWABLE_COLUMNS:
+        sql.append("SELECT date, hour, 'renewable', '%s', 'negative', %s, 0 FROM batch.renewable WHERE %s < 0" % (c, c, c))
+    for c in TOTAL_COLUMNS:
+        sql.append("SELECT date, hour, 'total', '%s', 'negative', %s, 0 FROM batch.total WHERE %s < 0" % (c, c, c))
+    return sql
+
+def check_sums(tolerance):
+    return ["""SELECT r.date, r.hour, 'total', 'renewables', 'sum', %s, t.renewables
+        FROM batch.renewable r JOIN batch.total t ON r.date = t.date AND r.hour = t.hour
+        WHERE ABS((%s) - t.renewables) > %d""" % (RENEWABLE_SUM, RENEWABLE_SUM, tolerance)]
+
+def check_duplicates(history):
+    sql = ["SELECT date, hour, '%s', '', 'duplicate', COUNT(*), 1 FROM batch.%s GROUP BY date, hour HAVING COUNT(*) > 1" % (t, t)
+            for t in ('renewable', 'total')]
+    # rows the db already holds for the hour with different values, e.g. a
+    # report whose header carries the date of another day; identical rows
+    # are the same file inserted before
+    for (t, columns) in (('renewable', RENEWABLE_COLUMNS), ('total', TOTAL_COLUMNS)):
+        if t in history:
+            sql.append("""SELECT b.date, b.hour, '%s', '', 'duplicate', COUNT(*) + 1, 1
+                FROM batch.%s b JOIN main.%s m ON m.date = b.date AND m.hour = b.hour
+                WHERE %s GROUP BY b.date, b.hour""" % (t, t, t, ' OR '.join('b.%s IS NOT m.%s' % (c, c) for c in columns)))
+    return sql
+
+def check_hours():
+    # hours outside the day
+    sql = ["SELECT date, hour, '%s', '', 'hour', hour, NULL FROM batch.%s WHERE hour NOT BETWEEN 1 AND 24" % (t, t)
+            for t in ('renewable', 'total')]
+    # per-day rule, recorded against hour 0
+    sql += ["""SELECT e.date, 0, '%s', '', 'hours', COUNT(DISTINCT b.hour), e.hours
+        FROM batch.expected e LEFT JOIN batch.%s b ON b.date = e.date AND b.hour BETWEEN 1 AND 24
+        GROUP BY e.date HAVING COUNT(DISTINCT b.hour) < e.hours""" % (t, t)
+            for t in ('renewable', 'total')]
+    return sql
+
+def check_spikes(history, zscore, baseline_days, baseline_min_days):
+    """
+    Rolling mean and variance per hour of day over the preceding
+    baseline_days, computed with a window over the db history plus the batch.
+    """
+    sql = []
+    for (table, col, expr) in SPIKE_SERIES:
+        series = "SELECT date, hour, %s AS v FROM batch.%s" % (expr, table)
+        if table in history:
+            series += " UNION ALL SELECT date, hour, %s AS v FROM main.%s WHERE date >= :since AND date NOT IN (SELECT date FROM batch.expected)" % (expr, table)
+        sql.append("""SELECT date, hour, '%s', '%s', 'spike', v, mu FROM (
+            SELECT date, hour, v,
+                AVG(v) OVER w AS mu,
+                AVG(v * v) OVER w - AVG(v) OVER w * AVG(v) OVER w AS var,
+                COUNT(v) OVER w AS n
+            FROM (%s)
+            WINDOW w AS (PARTITION BY hour ORDER BY date ROWS BETWEEN %d PRECEDING AND 1 PRECEDING))
+        WHERE date IN (SELECT date FROM batch.expected)
+            AND n >= %d AND var > 0 AND (v - mu) * (v - mu) > %f * var""" % (
+                table, col, series, baseline_days, baseline_min_days, zscore * zscore))
+    return sql
+
+# -----------------------------------------------------------------------------
+# Validator
+# -----------------------------------------------------------------------------
+def validate(logger, resource_name, sql_dir, db_dir, new_files, config, loaded=None):
+    """
+    Validate new_files against the database in db_dir and record violations.
+    Returns the number of violations found. If loaded is a list, the files
+    that could be read are appended to it.
+    """
+    import datetime
+    import sqlite3
+    db_path = os.path.join(db_dir, "%s_00.db" % resource_name)
+    conn    = sqlite3.connect(db_path)
+    try:
+        conn.execute("ATTACH DATABASE ':memory:' AS batch")
+        ok = load_batch(logger, conn, sql_dir, new_files)
+        if loaded is not None:
+            loaded.extend(ok)
+        days = [row[0] for row in conn.execute("SELECT DISTINCT date FROM batch.renewable UNION SELECT DISTINCT date FROM batch.total")]
+        if len(days) == 0:
+            return 0
+        conn.execute("CREATE TABLE batch.expected (date TEXT PRIMARY KEY, hours INT)")
+        conn.executemany("INSERT INTO batch.expected VALUES (?, ?)", [(d, expected_hours(d)) for d in days])
+        history = set(row[0] for row in conn.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'"))
+        since   = str(datetime.datetime.fromisoformat(min(days)[:10]) - datetime.timedelta(days=2 * config['baseline_days']))
+        queries = check_nulls() + check_negatives() + check_duplicates(history) + check_hours() + \
+                check_sums(config['sum_tolerance_mw']) + \
+                check_spikes(history, config['zscore'], config['baseline_days'], config['baseline_min_days'])
+        conn.execute(VIOLATION_DDL)
+        conn.execute("DELETE FROM main.violation WHERE date IN (SELECT date FROM batch.expected)")
+        before = conn.total_changes
+        for q in queries:
+            conn.execute("INSERT OR REPLACE INTO main.violation %s" % q, {'since': since} if ':since' in q else {})
+        count = conn.total_changes - before
+        conn.commit()
+        return count
+    finally:
+        conn.close()
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    from edl.resources import log
+    from edl.resources import state
+    resource_name   = manifest['name']
+    sql_dir         = config['source_dir']
+    db_dir          = config['working_dir']
+    state_file      = config['state_file']
+    new_files = artifact.new_files(state_file, sql_dir, '.sql')
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "sql_dir"   : sql_dir,
+        "db_dir"    : db_dir,
+        "state_file": state_file,
+        "new_files_count" : len(new_files),
+        "message"   : "started validating sql files",
+        })
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    loaded = []
+    violations = validate(logger, resource_name, sql_dir, db_dir, new_files, config, loaded)
+    # files that failed to load are retried on the next run
+    state.update(iter(loaded), state_file)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "new_files_count" : len(new_files),
+        "validated_count" : len(loaded),
+        "violations": violations,
+        "message"   : "finished validating sql files",
+        })
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+    c = config()
+    if not has_pending(m, c):
+        sys.exit(0)
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "35_vald.py"
+        })
+    run(logger, m, c)
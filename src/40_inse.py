@@ -20,23 +20,16 @@
 # 40_inse.py : parse resources from an xml file and insert into database
 # -----------------------------------------------------------------------------
 
-from edl.resources import db
-from edl.resources import log
-from edl.resources import state
-import datetime as dt
+import artifact
 import json
 import logging
 import os
-import pprint
-import sqlite3
 import sys
-import xml.dom.minidom as md
-import shutil
 
 # -----------------------------------------------------------------------------
 # Config
 # -----------------------------------------------------------------------------
-def config():
+def config(cwd=None):
     """
     config = {
             "source_dir"    : location of the xml files
@@ -44,7 +37,7 @@ def config():
             "state_file"    : fqpath to file that lists the inserted xml files
             }
     """
-    cwd                     = os.path.abspath(os.path.curdir)
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
     sql_dir                 = os.path.join(cwd, "sql")
     db_dir                  = os.path.join(cwd, "db")
     state_file              = os.path.join(db_dir, "state.txt")
@@ -55,16 +48,127 @@ def config():
             }
     return config
 
+# -----------------------------------------------------------------------------
+# Fast Path
+# -----------------------------------------------------------------------------
+def has_pending(manifest, config):
+    """
+    Return True if there are sql files not yet listed in the state file.
+    Uses only the stdlib, so that a cron invocation with nothing to insert
+    exits before importing edl and sqlite3.
+    """
+    sql_dir         = config['source_dir']
+    state_file      = config['state_file']
+    return len(artifact.new_files(state_file, sql_dir, '.sql')) > 0
+
+# -----------------------------------------------------------------------------
+# Sql File Helpers
+# -----------------------------------------------------------------------------
+def db_file(resource_name, db_dir):
+    return os.path.join(db_dir, "%s_00.db" % resource_name)
+
+def read_sql_file(path):
+    """
+    Return the statements in a sql file written by 30_pars.py, one per line.
+    path is the logical name, compressed variants are read transparently.
+    """
+    return [line.strip() for line in artifact.read_text(path).split('\n') if len(line.strip()) > 0]
+
+def add_derived_columns(conn):
+    """
+    Add the derived columns (see 30_pars.py) missing from tables created
+    before they existed. Tables that do not exist yet get them from the DDL
+    in the sql files.
+    """
+    import importlib
+    pars = importlib.import_module('30_pars')
+    for (table, columns) in pars.DERIVED_COLUMNS.items():
+        existing = set(row[1] for row in conn.execute("PRAGMA table_info(%s)" % table))
+        if len(existing) == 0:
+            continue
+        for (column, column_type) in columns:
+            if column not in existing:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
+
+def execute_sql_file(logger, conn, path):
+    """
+    Execute the statements in path on conn without committing, so that the
+    caller controls the transaction. Failed statements are logged and
+    skipped. Rows that are already in the db (UNIQUE conflicts) are expected
+    on reruns and only logged at debug. Returns the number of other failed
+    statements.
+    """
+    import sqlite3
+    from edl.resources import log
+    add_derived_columns(conn)
+    errors = 0
+    for sql in read_sql_file(path):
+        try:
+            conn.execute(sql)
+        except sqlite3.Error as e:
+            duplicate = isinstance(e, sqlite3.IntegrityError) and str(e).startswith('UNIQUE constraint failed')
+            if not duplicate:
+                errors += 1
+            (log.debug if duplicate else log.error)(logger, {
+                "name"      : __name__,
+                "method"    : "execute_sql_file",
+                "src"       : "40_inse.py",
+                "input"     : path,
+                "sql"       : sql,
+                "exception" : str(e),
+                })
+    return errors
+
+def insert_files(logger, resource_name, sql_dir, db_dir, new_files, failed=None):
+    """
+    Insert each sql file in its own transaction and yield its name once
+    committed. Files with failed statements are still committed, and their
+    failure counts are recorded in the failed dict, if given.
+    """
+    import sqlite3
+    from edl.resources import log
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(db_file(resource_name, db_dir))
+    try:
+        for f in new_files:
+            try:
+                errors = execute_sql_file(logger, conn, os.path.join(sql_dir, f))
+                conn.commit()
+                if errors > 0:
+                    if failed is not None:
+                        failed[f] = errors
+                    log.error(logger, {
+                        "name"      : __name__,
+                        "method"    : "insert_files",
+                        "src"       : "40_inse.py",
+                        "input"     : os.path.join(sql_dir, f),
+                        "failed_statements_count" : errors,
+                        })
+                yield f
+            except Exception as e:
+                conn.rollback()
+                log.error(logger, {
+                    "name"      : __name__,
+                    "method"    : "insert_files",
+                    "src"       : "40_inse.py",
+                    "input"     : os.path.join(sql_dir, f),
+                    "exception" : str(e),
+                    })
+    finally:
+        conn.close()
 
 # -----------------------------------------------------------------------------
 # Entrypoint
 # -----------------------------------------------------------------------------
 def run(logger, manifest, config):
+    from edl.resources import log
+    from edl.resources import state
     resource_name   = manifest['name']
     sql_dir         = config['source_dir']
     db_dir          = config['working_dir']
     state_file      = config['state_file']
-    new_files = state.new_files(resource_name, state_file, sql_dir, '.sql')
+    new_files = artifact.new_files(state_file, sql_dir, '.sql')
     log.info(logger, {
         "name"      : __name__,
         "method"    : "run",
@@ -75,7 +179,8 @@ def run(logger, manifest, config):
         "new_files_count" : len(new_files),
         "message"   : "started processing sql files",
         })
-    state.update(db.insert(logger, resource_name, sql_dir, db_dir, new_files), state_file)
+    failed = {}
+    state.update(insert_files(logger, resource_name, sql_dir, db_dir, new_files, failed), state_file)
     log.info(logger, {
         "name"      : __name__,
         "method"    : "run",
@@ -84,6 +189,7 @@ def run(logger, manifest, config):
         "db_dir"    : db_dir,
         "state_file": state_file,
         "new_files_count" : len(new_files),
+        "failed_files"  : failed,
         "message"   : "finished processing sql files",
         })
 
@@ -95,6 +201,12 @@ if __name__ == "__main__":
         loglevel = sys.argv[1]
     else:
         loglevel = "INFO"
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+    c = config()
+    if not has_pending(m, c):
+        sys.exit(0)
+    from edl.resources import log
     log.configure_logging()
     logger = logging.getLogger(__name__)
     logger.setLevel(loglevel)
@@ -103,6 +215,4 @@ if __name__ == "__main__":
         "method"    : "main",
         "src"       : "40_inse.py"
         })
-    with open('manifest.json', 'r') as json_file:
-        m = json.load(json_file)
-        run(logger, m, config())
\ No newline at end of file
+    run(logger, m, c)
\ No newline at end of file
@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# 45_bins.py : copy inserted rows into a fixed-width binary column store
+#
+# * bins/<column>.i32 holds one little-endian int32 per hour, NULL is stored
+#   as NULL_VALUE
+# * the value for (date, hour) lives at index
+#   (date - manifest['start_date']).days * 24 + hour - 1, so a range read is
+#   a seek, and with numpy a zero-copy view of a memory map
+# * days are written as they are inserted, missing days read as NULL
+# * reading requires numpy, writing only the stdlib
+# -----------------------------------------------------------------------------
+
+import datetime
+import json
+import logging
+import os
+import sys
+
+COLUMNS = {
+        'renewable' : ['geothermal', 'biomass', 'biogas', 'small_hydro', 'wind_total', 'solar_pv', 'solar_thermal', 'solar'],
+        'total'     : ['renewables', 'nuclear', 'thermal', 'imports', 'hydro'],
+        }
+HOURS       = 24
+DTYPE       = '<i4'
+NULL_VALUE  = -2**31
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config(cwd=None):
+    """
+    config = {
+            "source_dir"    : location of the database
+            "working_dir"   : location of the column files
+            "state_file"    : fqpath to file that lists the sql files copied to the column files
+            }
+    """
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
+    db_dir                  = os.path.join(cwd, "db")
+    bins_dir                = os.path.join(cwd, "bins")
+    state_file              = os.path.join(bins_dir, "state.txt")
+    config = {
+            "source_dir"    : db_dir,
+            "working_dir"   : bins_dir,
+            "state_file"    : state_file,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Fast Path
+# -----------------------------------------------------------------------------
+def has_pending(manifest, config):
+    """
+    Return True if db/state.txt lists sql files not yet in the column files.
+    Uses only the stdlib, so that a cron invocation with nothing to copy
+    exits before importing edl and sqlite3.
+    """
+    db_state_file   = os.path.join(config['source_dir'], "state.txt")
+    state_file      = config['state_file']
+    if not os.path.exists(db_state_file):
+        return False
+    done = set()
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            done = set(line.strip() for line in f)
+    with open(db_state_file, 'r') as f:
+        return any(line.strip() not in done for line in f if len(line.strip()) > 0)
+
+# -----------------------------------------------------------------------------
+# Column Store
+# -----------------------------------------------------------------------------
+def column_file(bins_dir, column):
+    return os.path.join(bins_dir, "%s.i32" % column)
+
+def hour_index(start_date, day, hour):
+    return (day - start_date).days * HOURS + hour - 1
+
+def file_day(f):
+    # content_green_renewrpt_20191030_DailyRenewablesWatch.sql
+    return datetime.datetime.strptime(f.split('_')[3], '%Y%m%d').date()
+
+def write_meta(bins_dir, start_date):
+    with open(os.path.join(bins_dir, "meta.json"), 'w') as f:
+        json.dump({
+            "start_date"    : [start_date.year, start_date.month, start_date.day],
+            "dtype"         : DTYPE,
+            "null"          : NULL_VALUE,
+            "hours_per_day" : HOURS,
+            }, f)
+
+def to_bytes(values):
+    """
+    Return values packed as DTYPE, little-endian on every host.
+    """
+    from array import array
+    a = array('i', values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+def write_day(fh, start_date, day, values):
+    """
+    Write the HOURS values for day at their fixed offset, padding any gap
+    before it with NULL_VALUE.
+    """
+    offset = hour_index(start_date, day, 1) * 4
+    fh.seek(0, os.SEEK_END)
+    end = fh.tell()
+    if end < offset:
+        fh.write(to_bytes([NULL_VALUE] * ((offset - end) // 4)))
+    fh.seek(offset)
+    fh.write(to_bytes(values))
+
+def copy_day(conn, handles, start_date, day):
+    key = str(datetime.datetime(day.year, day.month, day.day))
+    for (table, columns) in COLUMNS.items():
+        values = {c: [NULL_VALUE] * HOURS for c in columns}
+        for row in conn.execute("SELECT hour, %s FROM %s WHERE date = ?" % (', '.join(columns), table), (key,)):
+            hour = row[0]
+            if 1 <= hour <= HOURS:
+                for (c, v) in zip(columns, row[1:]):
+                    if isinstance(v, int):
+                        values[c][hour - 1] = v
+        for c in columns:
+            write_day(handles[c], start_date, day, values[c])
+
+def copy_files(logger, resource_name, start_date, db_dir, bins_dir, new_files):
+    import sqlite3
+    from edl.resources import log
+    db_path = os.path.join(db_dir, "%s_00.db" % resource_name)
+    conn    = sqlite3.connect(db_path)
+    handles = {}
+    try:
+        for columns in COLUMNS.values():
+            for c in columns:
+                path = column_file(bins_dir, c)
+                handles[c] = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        for f in new_files:
+            try:
+                copy_day(conn, handles, start_date, file_day(f))
+                yield f
+            except Exception as e:
+                log.error(logger, {
+                    "name"      : __name__,
+                    "method"    : "copy_files",
+                    "src"       : "45_bins.py",
+                    "input"     : f,
+                    "exception" : str(e),
+                    })
+    finally:
+        [fh.close() for fh in handles.values()]
+        conn.close()
+
+# -----------------------------------------------------------------------------
+# Reader
+# -----------------------------------------------------------------------------
+def read_column(bins_dir, column, start=None, end=None):
+    """
+    Return a read-only numpy view of column for the days in [start, end),
+    both datetime.date, defaulting to the whole file. NULL hours hold
+    NULL_VALUE. No data is copied, the view is backed by a memory map.
+    Raises ValueError if start is before the start_date of the store.
+    """
+    import numpy as np
+    with open(os.path.join(bins_dir, "meta.json"), 'r') as f:
+        start_date = datetime.date(*json.load(f)['start_date'])
+    if start is not None and start < start_date:
+        raise ValueError("start %s is before the column store start_date %s" % (start, start_date))
+    path = column_file(bins_dir, column)
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=DTYPE)
+    data = np.memmap(path, dtype=DTYPE, mode='r')
+    lo = 0 if start is None else hour_index(start_date, start, 1)
+    hi = len(data) if end is None else max(lo, hour_index(start_date, end, 1))
+    return data[lo:hi]
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    from edl.resources import log
+    from edl.resources import state
+    resource_name   = manifest['name']
+    start_date      = datetime.date(*manifest['start_date'])
+    db_dir          = config['source_dir']
+    bins_dir        = config['working_dir']
+    state_file      = config['state_file']
+    if not os.path.exists(bins_dir):
+        os.makedirs(bins_dir)
+    write_meta(bins_dir, start_date)
+    done = set()
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            done = set(line.strip() for line in f)
+    with open(os.path.join(db_dir, "state.txt"), 'r') as f:
+        new_files = [line.strip() for line in f if len(line.strip()) > 0 and line.strip() not in done]
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "db_dir"    : db_dir,
+        "bins_dir"  : bins_dir,
+        "state_file": state_file,
+        "new_files_count" : len(new_files),
+        "message"   : "started copying to column files",
+        })
+    state.update(copy_files(logger, resource_name, start_date, db_dir, bins_dir, new_files), state_file)
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+    c = config()
+    if not has_pending(m, c):
+        sys.exit(0)
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "45_bins.py"
+        })
+    run(logger, m, c)
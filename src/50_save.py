@@ -19,9 +19,6 @@
 # 50_save.py : save state files
 # -----------------------------------------------------------------------------
 
-from edl.resources import log
-from edl.resources import state
-from edl.resources import save
 import logging
 import os
 import sys
@@ -30,7 +27,7 @@ import json
 # -----------------------------------------------------------------------------
 # Config
 # -----------------------------------------------------------------------------
-def config():
+def config(cwd=None):
     """
     config = {
             "source_dir"    : location of the databases
@@ -38,7 +35,7 @@ def config():
             "state_file"    : fqpath to file that lists the created database files
             }
     """
-    cwd                     = os.path.abspath(os.path.curdir)
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
     db_dir                  = os.path.join(cwd, "db")
     save_dir                = os.path.join(cwd, "save")
     state_file              = os.path.join(save_dir, "state.txt")
@@ -54,6 +51,8 @@ def config():
 # Entrypoint
 # -----------------------------------------------------------------------------
 def run(logger, manifest, config):
+    from edl.resources import log
+    from edl.resources import save
     resource_name   = manifest['name']
     db_dir          = config['source_dir']
     save_dir        = config['working_dir']
@@ -101,6 +100,7 @@ if __name__ == "__main__":
         loglevel = sys.argv[1]
     else:
         loglevel = "INFO"
+    from edl.resources import log
     log.configure_logging()
     logger = logging.getLogger(__name__)
     logger.setLevel(loglevel)
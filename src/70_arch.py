@@ -20,13 +20,9 @@
 # 70_arch.py : archive distribution to s3
 # -----------------------------------------------------------------------------
 
-from edl.resources import log
-from edl.cli import feed as clifeed
-from edl.resources import state
 import json
 import logging
 import sys
-import shutil
 import os
 
 # -----------------------------------------------------------------------------
@@ -50,6 +46,9 @@ def config():
 # Entrypoint
 # -----------------------------------------------------------------------------
 def run(logger, manifest, config):
+    import shutil
+    from edl.resources import log
+    from edl.cli import feed as clifeed
     resource_name           = manifest['name']
     wasabi_bandwidth_limit  = config['wasabi_bwlimit']
     digitalocean_bandwidth_limit = config['digitalocean_bwlimit']
@@ -86,6 +85,7 @@ if __name__ == "__main__":
         loglevel = sys.argv[1]
     else:
         loglevel = "INFO"
+    from edl.resources import log
     log.configure_logging()
     logger = logging.getLogger(__name__)
     logger.setLevel(loglevel)
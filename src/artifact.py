@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# artifact.py : transparent read/write of optionally compressed txt/ and sql/
+#               artifacts
+#
+# * manifest['compression'] selects how artifacts are written: absent for
+#   plain files, "gzip" for <name>.gz, "zstd" for <name>.zst
+# * state files always list the logical, uncompressed name, and readers
+#   resolve it to whichever variant is on disk
+# * zstd can use a shared dictionary trained on the corpus:
+#
+#       src/artifact.py train sql
+#
+#   writes sql/zstd-<dict id>.dict; the newest dictionary in a directory is
+#   used for writing, and readers pick the dictionary by the id recorded in
+#   each frame, so retraining never orphans existing files
+# * loaded dictionaries are cached per directory and dict id, and the newest
+#   dict id per directory until the directory changes, so bulk writes do not
+#   reload and re-digest the dictionary for every file
+# * zstd needs the optional 'zstandard' package
+# -----------------------------------------------------------------------------
+
+import os
+import sys
+
+EXTENSIONS = {
+        'gzip'  : '.gz',
+        'zstd'  : '.zst',
+        }
+DICT_SIZE   = 112640
+LEVEL       = 19
+
+# (dir, dict id) -> ZstdCompressionDict, dir -> (dir mtime, newest dict id)
+_dicts      = {}
+_newest     = {}
+
+# -----------------------------------------------------------------------------
+# Names
+# -----------------------------------------------------------------------------
+def logical(name):
+    for ext in EXTENSIONS.values():
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def resolve(path):
+    """
+    Return the on-disk variant of the logical path, or path if none exists.
+    """
+    if os.path.exists(path):
+        return path
+    for ext in EXTENSIONS.values():
+        if os.path.exists(path + ext):
+            return path + ext
+    return path
+
+def exists(path):
+    return os.path.exists(resolve(path))
+
+def listdir(d):
+    """
+    Return the logical names of the files in d.
+    """
+    if not os.path.exists(d):
+        return set()
+    return set(logical(f) for f in os.listdir(d))
+
+def new_files(state_file, d, ending):
+    """
+    Return the sorted logical names in d that end with ending and are not
+    listed in state_file.
+    """
+    done = set()
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            done = set(line.strip() for line in f)
+    return sorted(f for f in listdir(d) if f.endswith(ending) and f not in done)
+
+# -----------------------------------------------------------------------------
+# Zstd Dictionaries
+# -----------------------------------------------------------------------------
+def zstd_dicts(d):
+    """
+    Return {dict id: path} for the dictionaries in d.
+    """
+    dicts = {}
+    if os.path.exists(d):
+        for f in os.listdir(d):
+            if f.startswith('zstd-') and f.endswith('.dict'):
+                dicts[int(f[len('zstd-'):-len('.dict')])] = os.path.join(d, f)
+    return dicts
+
+def load_dict(path):
+    import zstandard
+    with open(path, 'rb') as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+def cached_dict(d, dict_id):
+    """
+    Return the dictionary dict_id of directory d, loaded and digested for
+    compression once per process.
+    """
+    d   = os.path.abspath(d)
+    key = (d, dict_id)
+    if key not in _dicts:
+        zdict = load_dict(zstd_dicts(d)[dict_id])
+        zdict.precompute_compress(level=LEVEL)
+        _dicts[key] = zdict
+    return _dicts[key]
+
+def newest_dict(d):
+    d       = os.path.abspath(d)
+    if not os.path.exists(d):
+        return None
+    mtime   = os.stat(d).st_mtime_ns
+    if d not in _newest or _newest[d][0] != mtime:
+        dicts = zstd_dicts(d)
+        _newest[d] = (mtime, max(dicts, key=lambda i: os.path.getmtime(dicts[i])) if len(dicts) > 0 else None)
+    dict_id = _newest[d][1]
+    return None if dict_id is None else cached_dict(d, dict_id)
+
+def train(d, size=DICT_SIZE):
+    """
+    Train a zstd dictionary on the artifacts in d and return its path.
+    """
+    import zstandard
+    samples = [read_bytes(os.path.join(d, f)) for f in sorted(listdir(d))
+            if not f.endswith('.dict') and f != 'state.txt']
+    zdict = zstandard.train_dictionary(size, samples)
+    path = os.path.join(d, "zstd-%d.dict" % zdict.dict_id())
+    with open(path, 'wb') as f:
+        f.write(zdict.as_bytes())
+    return path
+
+# -----------------------------------------------------------------------------
+# Read / Write
+# -----------------------------------------------------------------------------
+def read_bytes(path):
+    """
+    Return the uncompressed content of the logical path.
+    """
+    path = resolve(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith(EXTENSIONS['gzip']):
+        import gzip
+        return gzip.decompress(data)
+    if path.endswith(EXTENSIONS['zstd']):
+        import zstandard
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        zdict = cached_dict(os.path.dirname(path), dict_id) if dict_id else None
+        return zstandard.ZstdDecompressor(dict_data=zdict).decompress(data)
+    return data
+
+def read_text(path):
+    return read_bytes(path).decode('utf-8')
+
+def write_bytes(path, data, compression=None):
+    """
+    Write data to the logical path, compressed as requested, and remove any
+    other variant of it. Returns the path written.
+    """
+    if compression is None:
+        target = path
+    elif compression == 'gzip':
+        import gzip
+        target = path + EXTENSIONS['gzip']
+        # mtime=0 keeps the output byte-identical across rewrites
+        data = gzip.compress(data, mtime=0)
+    elif compression == 'zstd':
+        import zstandard
+        target = path + EXTENSIONS['zstd']
+        data = zstandard.ZstdCompressor(level=LEVEL, dict_data=newest_dict(os.path.dirname(path))).compress(data)
+    else:
+        raise ValueError("unknown compression: %s" % compression)
+    with open(target, 'wb') as f:
+        f.write(data)
+    for variant in [path] + [path + ext for ext in EXTENSIONS.values()]:
+        if variant != target and os.path.exists(variant):
+            os.remove(variant)
+    return target
+
+def write_text(path, s, compression=None):
+    return write_bytes(path, s.encode('utf-8'), compression)
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == 'train':
+        print(train(os.path.abspath(sys.argv[2])))
+    else:
+        print("usage: artifact.py train <dir>")
+        sys.exit(1)
@@ -0,0 +1,426 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# daemon.py : long running ingest, instead of waiting for the next cron tick
+#
+# * downloads on a schedule matched to when CAISO publishes the report for
+#   the previous day: once at publish_time (America/Los_Angeles), then every
+#   retry_secs until yesterday's report shows up or retry_window_secs has
+#   passed. Only the days after the newest download are requested; older
+#   gaps are left to plan.py
+# * watches txt/ and sql/ with inotify (linux), falling back to polling the
+#   directory mtimes elsewhere, so the directories are listed only when
+#   they change
+# * each new text file is parsed, inserted, validated and copied to the
+#   column store as soon as it lands, sql files dropped in by other tools are
+#   inserted, validated and copied
+# * the stage modules, the parsed/inserted sets and the db connection are
+#   kept between events, the state files are only appended to; when the db
+#   file is replaced (rebuild.py) the connection and the sets are reloaded
+# * a failed download or event is logged and the daemon carries on, a failed
+#   download is retried like a late report
+# * catches up on anything pending once at startup
+# -----------------------------------------------------------------------------
+
+import datetime
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config(cwd=None):
+    """
+    config = {
+            "txt_dir"           : location of the text files
+            "sql_dir"           : location of the sql files
+            "db_dir"            : location of the database
+            "publish_time"      : [hour, minute] the previous day's report is expected, Pacific time
+            "retry_secs"        : delay between downloads while the report is late
+            "retry_window_secs" : stop retrying this long after publish_time
+            "poll_secs"         : directory poll interval when inotify is not available
+            }
+    """
+    cwd                     = os.path.abspath(cwd or os.path.curdir)
+    config = {
+            "txt_dir"           : os.path.join(cwd, "txt"),
+            "sql_dir"           : os.path.join(cwd, "sql"),
+            "db_dir"            : os.path.join(cwd, "db"),
+            "publish_time"      : [6, 0],
+            "retry_secs"        : 600,
+            "retry_window_secs" : 12 * 3600,
+            "poll_secs"         : 2,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Watchers
+# -----------------------------------------------------------------------------
+class InotifyWatcher:
+    """
+    Report files closed after writing, or moved into, the watched dirs.
+    Uses the inotify syscalls through ctypes, raises OSError where they are
+    not available.
+    """
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_TO     = 0x00000080
+    IN_NONBLOCK     = 0x00000800
+
+    def __init__(self, dirs):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        for d in dirs:
+            wd = libc.inotify_add_watch(self.fd, d.encode(), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed: %s" % d)
+            self.dirs[wd] = d
+
+    def wait(self, timeout):
+        """
+        Return the (dir, name) pairs that changed, waiting up to timeout
+        seconds for the first one.
+        """
+        import select
+        import struct
+        changed = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        i = 0
+        while i < len(buf):
+            (wd, mask, cookie, length) = struct.unpack_from('iIII', buf, i)
+            name = buf[i + 16:i + 16 + length].rstrip(b'\0').decode()
+            i += 16 + length
+            if wd in self.dirs and len(name) > 0:
+                changed.append((self.dirs[wd], name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher:
+    """
+    Report files added to the watched dirs. A dir is listed only when its
+    mtime changes.
+    """
+    def __init__(self, dirs, poll_secs):
+        self.poll_secs  = poll_secs
+        self.mtimes     = {d: os.stat(d).st_mtime_ns for d in dirs}
+        self.names      = {d: set(os.listdir(d)) for d in dirs}
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = []
+            for (d, mtime) in self.mtimes.items():
+                m = os.stat(d).st_mtime_ns
+                if m != mtime:
+                    self.mtimes[d] = m
+                    names = set(os.listdir(d))
+                    changed.extend((d, name) for name in sorted(names - self.names[d]))
+                    self.names[d] = names
+            remaining = deadline - time.monotonic()
+            if len(changed) > 0 or remaining <= 0:
+                return changed
+            time.sleep(min(self.poll_secs, remaining))
+
+    def close(self):
+        pass
+
+def watcher(logger, dirs, poll_secs):
+    from edl.resources import log
+    try:
+        w = InotifyWatcher(dirs)
+    except (OSError, AttributeError) as e:
+        w = PollWatcher(dirs, poll_secs)
+        log.info(logger, {
+            "name"      : __name__,
+            "method"    : "watcher",
+            "src"       : "daemon.py",
+            "exception" : str(e),
+            "message"   : "inotify unavailable, polling every %ss" % poll_secs,
+            })
+    return w
+
+# -----------------------------------------------------------------------------
+# Schedule
+# -----------------------------------------------------------------------------
+def publish_datetime(config, day):
+    from zoneinfo import ZoneInfo
+    (hour, minute) = config['publish_time']
+    return datetime.datetime(day.year, day.month, day.day, hour, minute, tzinfo=ZoneInfo('America/Los_Angeles'))
+
+def next_download(config, now, pending):
+    """
+    Return the epoch time of the next download: soon if the latest report is
+    still missing and it is within the retry window, otherwise the next
+    publish time.
+    """
+    from zoneinfo import ZoneInfo
+    local       = datetime.datetime.fromtimestamp(now, ZoneInfo('America/Los_Angeles'))
+    published   = publish_datetime(config, local.date())
+    if local < published:
+        return published.timestamp()
+    if pending and now < published.timestamp() + config['retry_window_secs']:
+        return now + config['retry_secs']
+    return publish_datetime(config, local.date() + datetime.timedelta(days=1)).timestamp()
+
+# -----------------------------------------------------------------------------
+# Ingest
+# -----------------------------------------------------------------------------
+class Ingest:
+    """
+    Warm parse/insert/validate/copy pipeline: stage modules, done sets and
+    the db connection live as long as the daemon.
+    """
+    def __init__(self, logger, manifest, config):
+        self.logger     = logger
+        self.manifest   = manifest
+        self.config     = config
+        self.artifact   = importlib.import_module('artifact')
+        self.down       = importlib.import_module('10_down')
+        self.pars       = importlib.import_module('30_pars')
+        self.inse       = importlib.import_module('40_inse')
+        self.plan       = importlib.import_module('plan')
+        self.sql_state  = os.path.join(config['sql_dir'], "state.txt")
+        self.db_state   = os.path.join(config['db_dir'], "state.txt")
+        self.db_path    = self.inse.db_file(manifest['name'], config['db_dir'])
+        self.conn       = None
+        self.connect()
+
+    def connect(self):
+        """
+        Open the db, and reread the state files, unless the open connection
+        is still on the current db file. rebuild.py renames a new db over the
+        old one, and rows inserted through the old connection would be lost.
+        """
+        import sqlite3
+        if self.conn is not None:
+            if os.path.exists(self.db_path) and os.stat(self.db_path).st_ino == self.db_ino:
+                return
+            self.conn.close()
+        self.conn       = sqlite3.connect(self.db_path)
+        self.db_ino     = os.stat(self.db_path).st_ino
+        self.parsed     = self.read_state(self.sql_state)
+        self.inserted   = self.read_state(self.db_state)
+
+    def read_state(self, state_file):
+        if not os.path.exists(state_file):
+            return set()
+        with open(state_file, 'r') as f:
+            return set(line.strip() for line in f if len(line.strip()) > 0)
+
+    def missing_days(self, state_file):
+        """
+        Return the days after the newest download through yesterday.
+        """
+        yesterday   = datetime.date.today() - datetime.timedelta(days=1)
+        latest      = self.down.latest_download(self.manifest, state_file)
+        if latest is None:
+            return [yesterday]
+        day         = datetime.datetime.strptime(latest, '%Y%m%d').date() + datetime.timedelta(days=1)
+        days        = []
+        while day <= yesterday:
+            days.append(day)
+            day += datetime.timedelta(days=1)
+        return days
+
+    def download(self):
+        """
+        Download the reports missing after the newest download, and return
+        whether yesterday's report is still missing.
+        """
+        from edl.resources import state
+        from edl.resources import web
+        c       = self.down.config()
+        urls    = [self.plan.url_for_day(self.manifest['url'], day) for day in self.missing_days(c['state_file'])]
+        if len(urls) == 0:
+            return False
+        fetched = list(web.download(self.logger, self.manifest['name'], self.manifest['download_delay_secs'],
+            urls, c['state_file'], c['working_dir'], ending='.txt'))
+        self.down.stage_txt_files(self.logger, c['working_dir'], c['source_dir'],
+            compression=self.manifest.get('compression'), names=[self.plan.txt_for_url(u) for u in fetched])
+        state.update(iter(fetched), c['state_file'])
+        return len(self.missing_days(c['state_file'])) > 0
+
+    def catch_up(self):
+        a = self.artifact
+        done = []
+        for f in a.new_files(self.sql_state, self.config['txt_dir'], 'DailyRenewablesWatch.txt'):
+            done.extend(self.on_txt(f))
+        for f in a.new_files(self.db_state, self.config['sql_dir'], '.sql'):
+            done.extend(self.on_sql(f))
+        self.refresh(done)
+
+    def on_event(self, d, name):
+        f = self.artifact.logical(name)
+        if d == self.config['txt_dir'] and f.endswith('DailyRenewablesWatch.txt'):
+            self.refresh(self.on_txt(f))
+        elif d == self.config['sql_dir'] and f.endswith('.sql'):
+            self.refresh(self.on_sql(f))
+
+    def refresh(self, files):
+        """
+        Validate the newly inserted sql files and copy them to the column
+        store, see plan.refresh.
+        """
+        if len(files) > 0:
+            self.plan.refresh(self.logger, self.manifest, self.config['sql_dir'], self.config['db_dir'], files)
+
+    def on_txt(self, f):
+        """
+        Parse and insert f, and return the sql files inserted.
+        """
+        from edl.resources import state
+        self.connect()
+        if f in self.parsed:
+            return []
+        ok = list(self.pars.parse_text_files(self.logger, self.manifest['name'], [f],
+            self.config['txt_dir'], self.config['sql_dir'], self.manifest.get('compression')))
+        if len(ok) == 0:
+            return []
+        self.parsed.add(f)
+        state.update(iter(ok), self.sql_state)
+        return self.on_sql("%s.sql" % os.path.splitext(f)[0])
+
+    def on_sql(self, f):
+        """
+        Insert f, and return the sql files inserted.
+        """
+        from edl.resources import log
+        from edl.resources import state
+        self.connect()
+        if f in self.inserted:
+            return []
+        path = os.path.join(self.config['sql_dir'], f)
+        try:
+            self.inse.execute_sql_file(self.logger, self.conn, path)
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            log.error(self.logger, {
+                "name"      : __name__,
+                "method"    : "on_sql",
+                "src"       : "daemon.py",
+                "input"     : path,
+                "exception" : str(e),
+                })
+            return []
+        self.inserted.add(f)
+        state.update(iter([f]), self.db_state)
+        log.info(self.logger, {
+            "name"      : __name__,
+            "method"    : "on_sql",
+            "resource"  : self.manifest['name'],
+            "input"     : f,
+            "message"   : "inserted",
+            })
+        return [f]
+
+    def close(self):
+        self.conn.close()
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def logged(logger, method, f, *args):
+    """
+    Call f(*args) and return its result, or log the error and return None, so
+    that a network error or a locked db does not stop the daemon.
+    """
+    from edl.resources import log
+    try:
+        return f(*args)
+    except Exception as e:
+        log.error(logger, {
+            "name"      : __name__,
+            "method"    : method,
+            "src"       : "daemon.py",
+            "args"      : [str(a) for a in args],
+            "exception" : str(e),
+            })
+        return None
+
+def run(logger, manifest, config):
+    from edl.resources import log
+    for d in (config['txt_dir'], config['sql_dir'], config['db_dir']):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    ingest  = Ingest(logger, manifest, config)
+    w       = watcher(logger, [config['txt_dir'], config['sql_dir']], config['poll_secs'])
+    try:
+        logged(logger, "catch_up", ingest.catch_up)
+        due = time.time()
+        while True:
+            if time.time() >= due:
+                pending = logged(logger, "download", ingest.download)
+                # a failed download is retried like a late report
+                pending = True if pending is None else pending
+                due     = next_download(config, time.time(), pending)
+                log.info(logger, {
+                    "name"      : __name__,
+                    "method"    : "run",
+                    "resource"  : manifest['name'],
+                    "pending"   : pending,
+                    "next_download" : datetime.datetime.fromtimestamp(due).isoformat(),
+                    })
+            for (d, name) in w.wait(max(0, due - time.time())):
+                logged(logger, "on_event", ingest.on_event, d, name)
+    finally:
+        w.close()
+        ingest.close()
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "daemon.py"
+        })
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+        try:
+            run(logger, m, config())
+        except KeyboardInterrupt:
+            pass
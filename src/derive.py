@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# derive.py : backfill the derived columns (solar_all, total_load, net_load,
+#             renewable_share) for rows inserted before they were computed
+#             at ingest
+#
+# * adds the columns to an existing db, then recomputes them for every row
+#   in one transaction, with the same statements 30_pars.py emits per day
+# * safe to rerun, does nothing if the db, or its renewable and total
+#   tables, do not exist yet
+# -----------------------------------------------------------------------------
+
+import importlib
+import json
+import logging
+import os
+import sys
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config():
+    """
+    config = {
+            "db_dir"        : location of the database
+            }
+    """
+    cwd                     = os.path.abspath(os.path.curdir)
+    config = {
+            "db_dir"        : os.path.join(cwd, "db"),
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    import sqlite3
+    from edl.resources import log
+    pars = importlib.import_module('30_pars')
+    inse = importlib.import_module('40_inse')
+    db_path = inse.db_file(manifest['name'], config['db_dir'])
+    # connecting would create an empty db that serve.py and 35_vald.py
+    # then take for a real one
+    tables  = set()
+    if os.path.exists(db_path):
+        conn = sqlite3.connect("file:%s?mode=ro" % db_path, uri=True)
+        try:
+            tables = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        finally:
+            conn.close()
+    if not {'renewable', 'total'} <= tables:
+        log.error(logger, {
+            "name"      : __name__,
+            "method"    : "run",
+            "resource"  : manifest['name'],
+            "db"        : db_path,
+            "message"   : "no renewable and total tables to backfill, run the insert stage first",
+            })
+        return
+    conn    = sqlite3.connect(db_path)
+    try:
+        inse.add_derived_columns(conn)
+        counts = {}
+        for sql in pars.gen_derived_sql():
+            counts[sql.split()[1]] = conn.execute(sql).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : manifest['name'],
+        "db"        : db_path,
+        "rows"      : counts,
+        "message"   : "backfilled derived columns",
+        })
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "derive.py"
+        })
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+        run(logger, m, config())
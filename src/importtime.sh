@@ -0,0 +1,98 @@
+#!/bin/bash
+
+# -----------------------------------------------------------------------------
+# importtime.sh : guard the cost of a cron invocation with nothing to do
+#
+# Builds a scratch feed in which every stage is up to date, then runs each
+# src/NN_*.py that has a has_pending() fast path as a script there, under
+# `python3 -X importtime`. A stage fails if its idle run exits non-zero, pulls
+# in any of the heavy modules, or if the modules it adds on top of what every
+# stage imports anyway (json, logging, ...) take longer than IMPORT_BUDGET_US.
+# The best of IMPORT_RUNS runs is compared against the budget.
+#
+# Stages without a fast path (save, archive) always do their work, so they
+# are only loaded as modules and checked for heavy imports.
+# -----------------------------------------------------------------------------
+
+BUDGET_US=${IMPORT_BUDGET_US:-1000}
+RUNS=${IMPORT_RUNS:-5}
+HEAVY='^(edl|requests|dateutil|sqlite3|zipfile|xml|pprint|shutil|glob)(\.|$)'
+SRC=$(cd "$(dirname "$0")" && pwd)
+
+# measure cached imports, as cron sees them, not bytecode compilation
+python3 -m compileall -q "$SRC" >/dev/null
+
+# modules imported by a bare interpreter, and by the preamble of every stage
+BARE=$(python3 -X importtime -c "pass" 2>&1 >/dev/null | awk -F'|' 'NR > 1 { gsub(/ /, "", $3); print $3 }')
+COMMON=$(python3 -X importtime -c "import datetime, json, logging, os, sys" 2>&1 >/dev/null | awk -F'|' 'NR > 1 { gsub(/ /, "", $3); print $3 }')
+
+# print "<self us> <module>" for the modules in importtime output $1 that are
+# not in baseline $2
+added() {
+    echo "$1" | awk -F'|' -v baseline="$2" '
+        BEGIN { n = split(baseline, b, "\n"); for (i = 1; i <= n; i++) seen[b[i]] = 1 }
+        /^import time:/ && NR > 1 {
+            name = $3; gsub(/ /, "", name)
+            split($1, self, ":"); gsub(/ /, "", self[2])
+            if (name != "" && !(name in seen)) print self[2], name
+        }'
+}
+
+# scratch feed: yesterday downloaded, nothing left to parse, insert or copy
+FEED=$(mktemp -d)
+trap 'rm -rf "$FEED"' EXIT
+mkdir -p "$FEED/zip" "$FEED/txt" "$FEED/sql" "$FEED/db" "$FEED/vald" "$FEED/bins"
+touch "$FEED/sql/state.txt" "$FEED/db/state.txt" "$FEED/vald/state.txt" "$FEED/bins/state.txt"
+python3 - "$SRC/../manifest.json" "$FEED" <<'EOF'
+import datetime, json, os, sys
+with open(sys.argv[1], 'r') as f:
+    m = json.load(f)
+yesterday = datetime.date.today() - datetime.timedelta(days=1)
+m['start_date'] = [yesterday.year, yesterday.month, yesterday.day]
+with open(os.path.join(sys.argv[2], 'manifest.json'), 'w') as f:
+    json.dump(m, f)
+with open(os.path.join(sys.argv[2], 'zip', 'state.txt'), 'w') as f:
+    f.write(m['url'].replace('_START_', yesterday.strftime('%Y%m%d')) + '\n')
+EOF
+
+status=0
+for stage in "$SRC"/[0-9]*.py; do
+    name="src/$(basename "$stage")"
+    if ! grep -q '^def has_pending' "$stage"; then
+        out=$(cd "$FEED" && PYTHONPATH="$SRC" python3 -X importtime -c "import importlib.util as u; s = u.spec_from_file_location('stage', '$stage'); s.loader.exec_module(u.module_from_spec(s))" 2>&1 >/dev/null)
+        heavy=$(added "$out" "$BARE" | awk '{ print $2 }' | grep -E "$HEAVY" | tr '\n' ' ')
+        if [ -n "$heavy" ]; then
+            echo "FAIL $name imports heavy modules at import time: $heavy"
+            status=1
+        else
+            echo "ok   $name (no idle path, import only)"
+        fi
+        continue
+    fi
+    total=""
+    for run in $(seq "$RUNS"); do
+        out=$(cd "$FEED" && PYTHONPATH="$SRC" python3 -X importtime "$stage" 2>&1 >/dev/null)
+        rc=$?
+        if [ "$rc" -ne 0 ]; then
+            break
+        fi
+        t=$(added "$out" "$COMMON" | awk '{ s += $1 } END { print s + 0 }')
+        if [ -z "$total" ] || [ "$t" -lt "$total" ]; then
+            total=$t
+        fi
+    done
+    heavy=$(added "$out" "$BARE" | awk '{ print $2 }' | grep -E "$HEAVY" | tr '\n' ' ')
+    if [ "$rc" -ne 0 ]; then
+        echo "FAIL $name idle run exited with $rc: $(echo "$out" | grep -v '^import time:' | tail -1)"
+        status=1
+    elif [ -n "$heavy" ]; then
+        echo "FAIL $name imports heavy modules when idle: $heavy"
+        status=1
+    elif [ "$total" -gt "$BUDGET_US" ]; then
+        echo "FAIL $name idle imports take ${total}us, budget ${BUDGET_US}us"
+        status=1
+    else
+        echo "ok   $name ${total}us"
+    fi
+done
+exit $status
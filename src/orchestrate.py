@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# orchestrate.py : run the stages of many feeds on shared worker pools
+#
+#   orchestrate.py LOGLEVEL path/to/feed-a/manifest.json path/to/feed-b/manifest.json ...
+#
+# * each feed runs its own src/NN_*.py scripts against its own directory, so
+#   feed state stays isolated
+# * downloads run on a shared thread pool, rate limited per host instead of
+#   sleeping per feed: requests to a host are spaced by the largest
+#   download_delay_secs of the feeds that use it
+# * as soon as a feed has downloaded, its parse/validate/insert stages are
+#   queued on a shared process pool, so cpu work overlaps across feeds
+# * feed code stays isolated: each feed is processed in a fresh worker, and
+#   the download threads load every feed's stage with that feed's own helper
+#   modules (artifact.py, ...)
+# * finally each feed's save stage commits its own repo
+# -----------------------------------------------------------------------------
+
+import concurrent.futures
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+DOWNLOAD_STAGE  = '10_down'
+LOAD_LOCK       = threading.Lock()
+PROCESS_STAGES  = ['20_unzp', '30_pars', '35_vald', '40_inse', '45_bins']
+SAVE_STAGE      = '50_save'
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config():
+    """
+    config = {
+            "download_threads"  : size of the shared download thread pool
+            "processes"         : size of the shared process pool, None for cpu count
+            "save"              : run each feed's save stage when done
+            }
+    """
+    config = {
+            "download_threads"  : 8,
+            "processes"         : None,
+            "save"              : True,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Rate Limiter
+# -----------------------------------------------------------------------------
+class HostLimiter:
+    """
+    Space requests to the same host by at least the host's delay, across all
+    threads.
+    """
+    def __init__(self, delays):
+        self.delays = delays
+        self.next   = {}
+        self.lock   = threading.Lock()
+
+    def __call__(self, url):
+        from urllib.parse import urlparse
+        host = urlparse(url).netloc
+        with self.lock:
+            now     = time.monotonic()
+            slot    = max(now, self.next.get(host, now))
+            self.next[host] = slot + self.delays.get(host, 0)
+        if slot > now:
+            time.sleep(slot - now)
+
+# -----------------------------------------------------------------------------
+# Feed Helpers
+# -----------------------------------------------------------------------------
+def load_stage(feed_dir, manifest, stage):
+    """
+    Import feed_dir/src/<stage>.py under a name unique to the feed, or return
+    None if the feed does not have that stage. The stage's module level
+    imports of its siblings (artifact, ...) resolve to the feed's own src
+    dir; sys.path and sys.modules are restored afterwards, so feeds loaded in
+    the same process do not see each other's helpers.
+    """
+    src_dir = os.path.join(feed_dir, 'src')
+    path = os.path.join(src_dir, '%s.py' % stage)
+    if not os.path.exists(path):
+        return None
+    name = "%s_%s" % (manifest['name'].replace('-', '_'), stage)
+    siblings = [os.path.splitext(f)[0] for f in os.listdir(src_dir) if f.endswith('.py')]
+    with LOAD_LOCK:
+        saved_path      = list(sys.path)
+        saved_modules   = {n: sys.modules.pop(n) for n in siblings if n in sys.modules}
+        sys.path.insert(0, src_dir)
+        try:
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path[:] = saved_path
+            for n in siblings:
+                sys.modules.pop(n, None)
+            sys.modules.update(saved_modules)
+    return module
+
+def run_stage(logger, feed_dir, manifest, stage, extra=None):
+    module = load_stage(feed_dir, manifest, stage)
+    if module is None:
+        return False
+    c = module.config(feed_dir)
+    c.update(extra or {})
+    if hasattr(module, 'has_pending') and not module.has_pending(manifest, c):
+        return False
+    module.run(logger, manifest, c)
+    return True
+
+def worker_logger(loglevel):
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    return logger
+
+def download_feed(logger, feed_dir, manifest, limiter):
+    return run_stage(logger, feed_dir, manifest, DOWNLOAD_STAGE, {'throttle': limiter})
+
+def process_feed(loglevel, feed_dir, manifest, stages):
+    """
+    Run stages for one feed, in order. Runs in a fresh worker process, which
+    has its own cwd and sys.path, so stages that rely on the cwd see the
+    feed's directory, and imports made while a stage runs (40_inse imports
+    30_pars) resolve to the feed's src dir.
+    """
+    from edl.resources import log
+    logger = worker_logger(loglevel)
+    os.chdir(feed_dir)
+    sys.path.insert(0, os.path.join(feed_dir, 'src'))
+    ran = []
+    for stage in stages:
+        try:
+            if run_stage(logger, feed_dir, manifest, stage):
+                ran.append(stage)
+        except Exception as e:
+            log.error(logger, {
+                "name"      : __name__,
+                "method"    : "process_feed",
+                "src"       : "orchestrate.py",
+                "resource"  : manifest['name'],
+                "stage"     : stage,
+                "exception" : str(e),
+                })
+            break
+    return ran
+
+def read_manifests(paths):
+    feeds = []
+    for path in paths:
+        with open(path, 'r') as json_file:
+            feeds.append((os.path.dirname(os.path.abspath(path)), json.load(json_file)))
+    return feeds
+
+def host_delays(feeds):
+    from urllib.parse import urlparse
+    delays = {}
+    for (feed_dir, manifest) in feeds:
+        host = urlparse(manifest['url']).netloc
+        delays[host] = max(delays.get(host, 0), manifest.get('download_delay_secs', 0))
+    return delays
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, loglevel, manifest_paths, config):
+    from edl.resources import log
+    feeds   = read_manifests(manifest_paths)
+    limiter = HostLimiter(host_delays(feeds))
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "feeds"     : [m['name'] for (d, m) in feeds],
+        "hosts"     : limiter.delays,
+        "message"   : "started",
+        })
+    with concurrent.futures.ThreadPoolExecutor(config['download_threads']) as threads, \
+            concurrent.futures.ProcessPoolExecutor(config['processes'], max_tasks_per_child=1) as procs:
+        downloads = {threads.submit(download_feed, logger, d, m, limiter): (d, m) for (d, m) in feeds}
+        processing = {}
+        for f in concurrent.futures.as_completed(downloads):
+            (d, m) = downloads[f]
+            if f.exception() is not None:
+                log.error(logger, {
+                    "name"      : __name__,
+                    "method"    : "run",
+                    "resource"  : m['name'],
+                    "stage"     : DOWNLOAD_STAGE,
+                    "exception" : str(f.exception()),
+                    })
+            processing[procs.submit(process_feed, loglevel, d, m, PROCESS_STAGES)] = (d, m)
+        for f in concurrent.futures.as_completed(processing):
+            (d, m) = processing[f]
+            log.info(logger, {
+                "name"      : __name__,
+                "method"    : "run",
+                "resource"  : m['name'],
+                "stages"    : f.result() if f.exception() is None else str(f.exception()),
+                "message"   : "processed",
+                })
+        if config['save']:
+            saves = [procs.submit(process_feed, loglevel, d, m, [SAVE_STAGE]) for (d, m) in feeds]
+            concurrent.futures.wait(saves)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "feeds_count" : len(feeds),
+        "message"   : "finished",
+        })
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    logger = worker_logger(loglevel)
+    from edl.resources import log
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "orchestrate.py"
+        })
+    run(logger, loglevel, sys.argv[2:] or ['manifest.json'], config())
@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# plan.py : find missing or incomplete days and push only those through the
+#           download, parse and insert stages
+#
+# * cross references zip/state.txt, sql/state.txt, db/state.txt and the hour
+#   counts in the db for every day from start_date through yesterday
+# * each gap is tagged with the earliest stage that needs to rerun:
+#     download : never downloaded, or the text file is gone and there is no
+#                sql file to insert from
+#     parse    : downloaded, but not parsed (or parsing failed), or the sql
+#                file is gone
+#     insert   : parsed, but not inserted
+#     hours    : inserted, but the db holds fewer hours than the day has,
+#                so the report is fetched again
+#     short    : as hours, but a refetched report was short too; these days
+#                are listed in zip/short.txt and not fetched again (delete
+#                the line to retry)
+# * a gap that fails to insert is logged and does not stop the others
+# * a reinserted day replaces the rows already in the db, so corrected values
+#   in a refetched report are kept, and the refilled days are revalidated and
+#   rewritten in the column store
+# * after running, the days that are still missing are printed to stdout
+# * `plan.py INFO dry-run` prints the plan without doing any work
+# -----------------------------------------------------------------------------
+
+import artifact
+import collections
+import datetime
+import importlib
+import json
+import logging
+import os
+import sys
+
+Gap = collections.namedtuple('Gap', ['day', 'reason', 'url', 'txt_file', 'sql_file'])
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config():
+    """
+    config = {
+            "zip_dir"       : location of the downloaded files
+            "txt_dir"       : location of the text files
+            "sql_dir"       : location of the sql files
+            "db_dir"        : location of the database
+            "short_file"    : fqpath to file that lists the urls refetched and still short
+            "dry_run"       : only print the plan
+            }
+    """
+    cwd                     = os.path.abspath(os.path.curdir)
+    config = {
+            "zip_dir"       : os.path.join(cwd, "zip"),
+            "txt_dir"       : os.path.join(cwd, "txt"),
+            "sql_dir"       : os.path.join(cwd, "sql"),
+            "db_dir"        : os.path.join(cwd, "db"),
+            "short_file"    : os.path.join(cwd, "zip", "short.txt"),
+            "dry_run"       : False,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Planner
+# -----------------------------------------------------------------------------
+def read_state(state_file):
+    if not os.path.exists(state_file):
+        return set()
+    with open(state_file, 'r') as f:
+        return set(line.strip() for line in f if len(line.strip()) > 0)
+
+def url_for_day(resource_url, day):
+    return resource_url.replace('_START_', day.strftime('%Y%m%d'))
+
+def txt_for_url(url):
+    # http://content.caiso.com/green/renewrpt/20191030_DailyRenewablesWatch.txt
+    #   -> content_green_renewrpt_20191030_DailyRenewablesWatch.txt
+    from urllib.parse import urlparse
+    u = urlparse(url)
+    return '_'.join([u.netloc.split('.')[0]] + u.path.strip('/').split('/'))
+
+def db_hours(db_path):
+    """
+    Return {'YYYY-MM-DD': hours} where hours is the smaller of the renewable
+    and total row counts for that day.
+    """
+    import sqlite3
+    if not os.path.exists(db_path):
+        return {}
+    conn = sqlite3.connect("file:%s?mode=ro" % db_path, uri=True)
+    try:
+        tables = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        counts = {}
+        for table in ('renewable', 'total'):
+            if table not in tables:
+                return {}
+            for (date, n) in conn.execute("SELECT substr(date, 1, 10), COUNT(*) FROM %s GROUP BY date" % table):
+                counts[date] = min(n, counts.get(date, n))
+        return counts
+    finally:
+        conn.close()
+
+def plan(manifest, config, today=None):
+    """
+    Return the list of Gaps, in date order, from start_date through the day
+    before today.
+    """
+    vald = importlib.import_module('35_vald')
+    inse = importlib.import_module('40_inse')
+    downloaded  = read_state(os.path.join(config['zip_dir'], "state.txt"))
+    parsed      = read_state(os.path.join(config['sql_dir'], "state.txt"))
+    inserted    = read_state(os.path.join(config['db_dir'], "state.txt"))
+    short       = read_state(config['short_file'])
+    hours       = db_hours(inse.db_file(manifest['name'], config['db_dir']))
+    txt_files   = artifact.listdir(config['txt_dir'])
+    sql_files   = artifact.listdir(config['sql_dir'])
+    today       = today or datetime.date.today()
+    day         = datetime.date(*manifest['start_date'])
+    gaps        = []
+    while day < today:
+        url         = url_for_day(manifest['url'], day)
+        txt_file    = txt_for_url(url)
+        sql_file    = "%s.sql" % os.path.splitext(txt_file)[0]
+        unparsed    = txt_file not in parsed or sql_file not in sql_files
+        reason      = None
+        if url not in downloaded or (unparsed and txt_file not in txt_files):
+            reason = 'download'
+        elif unparsed:
+            reason = 'parse'
+        elif sql_file not in inserted:
+            reason = 'insert'
+        elif hours.get(day.isoformat(), 0) < vald.expected_hours(day.isoformat()):
+            reason = 'short' if url in short else 'hours'
+        if reason is not None:
+            gaps.append(Gap(day, reason, url, txt_file, sql_file))
+        day += datetime.timedelta(days=1)
+    return gaps
+
+# -----------------------------------------------------------------------------
+# Executor
+# -----------------------------------------------------------------------------
+def delete_day(conn, day):
+    key     = str(datetime.datetime(day.year, day.month, day.day))
+    tables  = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    for table in ('renewable', 'total'):
+        if table in tables:
+            conn.execute("DELETE FROM %s WHERE date = ?" % table, (key,))
+
+def refresh(logger, manifest, sql_dir, db_dir, files):
+    """
+    Revalidate the refilled sql files and rewrite their days in the column
+    store. Both stages key on state file names, which a refill does not
+    change, so they would otherwise never see the new rows.
+    """
+    from edl.resources import state
+    vald = importlib.import_module('35_vald')
+    bins = importlib.import_module('45_bins')
+    resource_name   = manifest['name']
+    start_date      = datetime.date(*manifest['start_date'])
+    vald_config     = vald.config()
+    bins_config     = bins.config()
+    for d in (os.path.dirname(vald_config['state_file']), bins_config['working_dir']):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    loaded = []
+    vald.validate(logger, resource_name, sql_dir, db_dir, files, vald_config, loaded)
+    validated = read_state(vald_config['state_file'])
+    state.update(iter([f for f in loaded if f not in validated]), vald_config['state_file'])
+    bins.write_meta(bins_config['working_dir'], start_date)
+    copied = read_state(bins_config['state_file'])
+    state.update(iter([f for f in bins.copy_files(logger, resource_name, start_date, db_dir, bins_config['working_dir'], files)
+        if f not in copied]), bins_config['state_file'])
+
+def fill(logger, manifest, config, gaps):
+    """
+    Drive gaps through download, parse and insert, touching nothing else.
+    Returns the sql files inserted.
+    """
+    import sqlite3
+    import tempfile
+    from edl.resources import log
+    from edl.resources import state
+    from edl.resources import web
+    down = importlib.import_module('10_down')
+    pars = importlib.import_module('30_pars')
+    inse = importlib.import_module('40_inse')
+    resource_name   = manifest['name']
+    zip_dir         = config['zip_dir']
+    txt_dir         = config['txt_dir']
+    sql_dir         = config['sql_dir']
+    db_dir          = config['db_dir']
+
+    # download, against an empty scratch state file so refetches are not
+    # filtered out by zip/state.txt
+    fetch   = [g.url for g in gaps if g.reason in ('download', 'hours')]
+    fetched = []
+    if len(fetch) > 0:
+        with tempfile.NamedTemporaryFile('w', dir=zip_dir, suffix='.plan') as scratch:
+            fetched = list(web.download(logger, resource_name, manifest['download_delay_secs'],
+                fetch, scratch.name, zip_dir, ending='.txt'))
+        down.stage_txt_files(logger, zip_dir, txt_dir, overwrite=True, compression=manifest.get('compression'))
+        zip_state = os.path.join(zip_dir, "state.txt")
+        downloaded = read_state(zip_state)
+        state.update(iter([u for u in fetched if u not in downloaded]), zip_state)
+
+    # parse every gap whose text file is now on disk, short days only if
+    # the report was fetched again
+    if not os.path.exists(sql_dir):
+        os.makedirs(sql_dir)
+    sql_state   = os.path.join(sql_dir, "state.txt")
+    parsed      = read_state(sql_state)
+    reparse     = [g for g in gaps if (g.reason in ('download', 'parse') or (g.reason == 'hours' and g.url in fetched))
+            and artifact.exists(os.path.join(txt_dir, g.txt_file))]
+    ok          = set(pars.parse_text_files(logger, resource_name, [g.txt_file for g in reparse], txt_dir, sql_dir, manifest.get('compression')))
+    state.update(iter([f for f in sorted(ok) if f not in parsed]), sql_state)
+
+    # insert every gap whose sql file was (re)generated, or was never
+    # inserted, replacing whatever rows the db already holds for the day
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    db_state    = os.path.join(db_dir, "state.txt")
+    inserted    = read_state(db_state)
+    reinsert    = [g for g in gaps if g.reason == 'insert' or g.txt_file in ok]
+    conn        = sqlite3.connect(inse.db_file(resource_name, db_dir))
+    done        = []
+    try:
+        for g in reinsert:
+            try:
+                delete_day(conn, g.day)
+                inse.execute_sql_file(logger, conn, os.path.join(sql_dir, g.sql_file))
+                conn.commit()
+                done.append(g.sql_file)
+            except Exception as e:
+                conn.rollback()
+                log.error(logger, {
+                    "name"      : __name__,
+                    "method"    : "fill",
+                    "src"       : "plan.py",
+                    "input"     : os.path.join(sql_dir, g.sql_file),
+                    "exception" : str(e),
+                    })
+    finally:
+        conn.close()
+    state.update(iter([f for f in done if f not in inserted]), db_state)
+    if len(done) > 0:
+        refresh(logger, manifest, sql_dir, db_dir, done)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "fill",
+        "resource"  : resource_name,
+        "fetched_count"  : len(fetch),
+        "parsed_count"   : len(ok),
+        "inserted_count" : len(done),
+        })
+    return done
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    from edl.resources import log
+    gaps = plan(manifest, config)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : manifest['name'],
+        "gaps"      : dict(collections.Counter(g.reason for g in gaps)),
+        "message"   : "planned",
+        })
+    if len(gaps) > 0 and not config['dry_run']:
+        done = set(fill(logger, manifest, config, gaps))
+        refetched = set(g.day for g in gaps if g.reason == 'hours')
+        gaps = plan(manifest, config)
+        # refetched, reinserted and still short: the published report is
+        # short, stop fetching it every night
+        short = [g.url for g in gaps if g.reason == 'hours' and g.day in refetched and g.sql_file in done]
+        if len(short) > 0:
+            from edl.resources import state
+            state.update(iter(short), config['short_file'])
+            gaps = [g._replace(reason='short') if g.url in short else g for g in gaps]
+    for g in gaps:
+        print("%s\t%s" % (g.day.isoformat(), g.reason))
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "plan.py"
+        })
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+        c = config()
+        c['dry_run'] = len(sys.argv) > 2 and sys.argv[2] == 'dry-run'
+        run(logger, m, c)
@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# rebuild.py : rebuild the database from the full text archive
+#
+# * parses every txt/ file and inserts it into a side database,
+#   db/<name>_00.db.rebuild, in batches of 'batch_size' files
+# * each batch commits its rows together with a checkpoint row per file, so
+#   an interrupted rebuild resumes from the last committed batch when rerun
+# * when every file is processed, sql/state.txt and db/state.txt are
+#   rewritten, vald/state.txt and bins/state.txt are emptied so validation
+#   and the column store rerun against the new rows, and the side database
+#   is renamed over the live one, so readers never see a half-built database
+# * the new state files are staged, and a .swap marker written, before
+#   anything is renamed; a rebuild interrupted during the swap finishes it
+#   when rerun
+# * to discard a partial rebuild and start over, delete the .rebuild file
+# -----------------------------------------------------------------------------
+
+import artifact
+import importlib
+import json
+import logging
+import os
+import sys
+
+CHECKPOINT_DDL = 'CREATE TABLE IF NOT EXISTS rebuild_checkpoint (txt_file TEXT PRIMARY KEY, sql_file TEXT);'
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config():
+    """
+    config = {
+            "source_dir"    : location of the text files
+            "sql_dir"       : location of the sql files
+            "working_dir"   : location of the database
+            "sql_state_file": fqpath to file that lists the parsed text files
+            "db_state_file" : fqpath to file that lists the inserted sql files
+            "vald_state_file": fqpath to file that lists the validated sql files
+            "bins_state_file": fqpath to file that lists the sql files in the column store
+            "batch_size"    : number of text files committed per checkpoint
+            }
+    """
+    cwd                     = os.path.abspath(os.path.curdir)
+    config = {
+            "source_dir"    : os.path.join(cwd, "txt"),
+            "sql_dir"       : os.path.join(cwd, "sql"),
+            "working_dir"   : os.path.join(cwd, "db"),
+            "sql_state_file": os.path.join(cwd, "sql", "state.txt"),
+            "db_state_file" : os.path.join(cwd, "db", "state.txt"),
+            "vald_state_file": os.path.join(cwd, "vald", "state.txt"),
+            "bins_state_file": os.path.join(cwd, "bins", "state.txt"),
+            "batch_size"    : 100,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Rebuild Helpers
+# -----------------------------------------------------------------------------
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def write_state_file(path, items):
+    """
+    Write items to a temp file next to path and return the temp file name,
+    the caller renames it into place.
+    """
+    tmp = "%s.rebuild" % path
+    with open(tmp, 'w') as f:
+        [f.write("%s\n" % item) for item in items]
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp
+
+def finish_swap(logger, marker, side_path, renames):
+    """
+    Drop the checkpoint table from the side db, rename each staged
+    (tmp, path) pair still present into place, in order, then remove the
+    swap marker. Safe to repeat after a crash.
+    """
+    import sqlite3
+    from edl.resources import log
+    if os.path.exists(side_path):
+        conn = sqlite3.connect(side_path)
+        try:
+            conn.execute("DROP TABLE IF EXISTS rebuild_checkpoint")
+            conn.commit()
+        finally:
+            conn.close()
+    for (tmp, path) in renames:
+        if os.path.exists(tmp):
+            os.replace(tmp, path)
+    os.remove(marker)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "finish_swap",
+        "src"       : "rebuild.py",
+        "renamed"   : [path for (tmp, path) in renames],
+        })
+
+def rebuild_batch(logger, resource_name, conn, txt_dir, sql_dir, files, compression=None):
+    """
+    Parse and insert files into conn as a single transaction, with a
+    checkpoint row for every file that parsed. Returns the number of files
+    checkpointed.
+    """
+    from edl.resources import log
+    pars = importlib.import_module('30_pars')
+    inse = importlib.import_module('40_inse')
+    done = 0
+    for f in files:
+        try:
+            pars.parse_text_file(logger, resource_name, txt_dir, sql_dir, f, compression)
+        except Exception as e:
+            log.error(logger, {
+                "name"      : __name__,
+                "method"    : "rebuild_batch",
+                "src"       : "rebuild.py",
+                "input"     : os.path.join(txt_dir, f),
+                "exception" : str(e),
+                })
+            continue
+        sql_file = "%s.sql" % os.path.splitext(f)[0]
+        inse.execute_sql_file(logger, conn, os.path.join(sql_dir, sql_file))
+        conn.execute("INSERT OR REPLACE INTO rebuild_checkpoint VALUES (?, ?)", (f, sql_file))
+        done += 1
+    conn.commit()
+    return done
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    import sqlite3
+    from edl.resources import log
+    inse = importlib.import_module('40_inse')
+    resource_name   = manifest['name']
+    txt_dir         = config['source_dir']
+    sql_dir         = config['sql_dir']
+    db_dir          = config['working_dir']
+    sql_state_file  = config['sql_state_file']
+    db_state_file   = config['db_state_file']
+    batch_size      = config['batch_size']
+    for d in (sql_dir, db_dir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    db_path     = inse.db_file(resource_name, db_dir)
+    side_path   = "%s.rebuild" % db_path
+    marker      = "%s.swap" % side_path
+    reset_state_files = [p for p in (config['vald_state_file'], config['bins_state_file'])
+            if os.path.exists(os.path.dirname(p))]
+    # state files first, the db last
+    renames     = [("%s.rebuild" % p, p) for p in [sql_state_file, db_state_file] + reset_state_files] + \
+            [(side_path, db_path)]
+    if os.path.exists(marker):
+        finish_swap(logger, marker, side_path, renames)
+        return
+    conn        = sqlite3.connect(side_path)
+    conn.execute(CHECKPOINT_DDL)
+    conn.commit()
+    done    = set(row[0] for row in conn.execute("SELECT txt_file FROM rebuild_checkpoint"))
+    files   = sorted(f for f in artifact.listdir(txt_dir) if f.endswith('DailyRenewablesWatch.txt') and f not in done)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "db"        : side_path,
+        "resumed_count" : len(done),
+        "todo_count": len(files),
+        "message"   : "started rebuild",
+        })
+    todo = len(files)
+    for batch in batches(files, batch_size):
+        count = rebuild_batch(logger, resource_name, conn, txt_dir, sql_dir, batch, manifest.get('compression'))
+        done.update(batch)
+        todo -= len(batch)
+        log.info(logger, {
+            "name"      : __name__,
+            "method"    : "run",
+            "resource"  : resource_name,
+            "batch_count" : count,
+            "done_count": len(done),
+            "todo_count": todo,
+            "message"   : "checkpoint",
+            })
+
+    # swap: stage the state files, mark the swap as started, then drop the
+    # checkpoint and rename over; until the marker exists a crash resumes
+    # from the checkpoints
+    checkpoints = conn.execute("SELECT txt_file, sql_file FROM rebuild_checkpoint ORDER BY txt_file").fetchall()
+    conn.close()
+    write_state_file(sql_state_file, [c[0] for c in checkpoints])
+    write_state_file(db_state_file, [c[1] for c in checkpoints])
+    [write_state_file(p, []) for p in reset_state_files]
+    with open(marker, 'w') as f:
+        f.flush()
+        os.fsync(f.fileno())
+    finish_swap(logger, marker, side_path, renames)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "db"        : db_path,
+        "files_count" : len(checkpoints),
+        "message"   : "finished rebuild",
+        })
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    from edl.resources import log
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "rebuild.py"
+        })
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+        run(logger, m, config())
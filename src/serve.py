@@ -0,0 +1,282 @@
+#! /usr/bin/env python3
+# edl : common library for the energy-dashboard tool-chain
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# -----------------------------------------------------------------------------
+# serve.py : serve time-range slices of the database over http
+#
+# * GET /renewable?start=2019-10-01&end=2019-10-08&columns=wind_total
+# * GET /total?start=2019-10-01&end=2019-10-08&format=csv
+# * start is inclusive, end is exclusive, both are YYYY-MM-DD
+# * format is 'ndjson' (default) or 'csv'
+# * responses are streamed from the cursor in chunks, and carry an ETag
+#   derived from db/state.txt and the db file, so clients can send
+#   If-None-Match
+# -----------------------------------------------------------------------------
+
+from edl.resources import log
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import csv
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+TABLES  = ('renewable', 'total')
+FORMATS = {
+        'ndjson'    : 'application/x-ndjson',
+        'csv'       : 'text/csv',
+        }
+
+# -----------------------------------------------------------------------------
+# Config
+# -----------------------------------------------------------------------------
+def config():
+    """
+    config = {
+            "working_dir"   : location of the database
+            "state_file"    : fqpath to file that lists the inserted sql files
+            "host"          : interface to bind to
+            "port"          : port to listen on
+            "chunk_rows"    : number of rows fetched from the cursor per chunk
+            }
+    """
+    cwd                     = os.path.abspath(os.path.curdir)
+    db_dir                  = os.path.join(cwd, "db")
+    state_file              = os.path.join(db_dir, "state.txt")
+    config = {
+            "working_dir"   : db_dir,
+            "state_file"    : state_file,
+            "host"          : "127.0.0.1",
+            "port"          : 8080,
+            "chunk_rows"    : 1000,
+            }
+    return config
+
+# -----------------------------------------------------------------------------
+# Query Helpers
+# -----------------------------------------------------------------------------
+def db_file(resource_name, db_dir):
+    return os.path.join(db_dir, "%s_00.db" % resource_name)
+
+def connect(db_path):
+    # read-only, so that a serving process can never lock out the insert stage
+    return sqlite3.connect("file:%s?mode=ro" % db_path, uri=True, check_same_thread=False)
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]
+
+def parse_day(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date().isoformat()
+
+def build_query(conn, table, params):
+    """
+    Return (sql, args, columns) for the requested slice. Raises ValueError on
+    bad input, the message is returned to the client.
+    """
+    if table not in TABLES:
+        raise ValueError("unknown table: %s" % table)
+    available = table_columns(conn, table)
+    if 'columns' in params:
+        requested = [c for c in params['columns'][0].split(',') if len(c) > 0]
+        unknown = [c for c in requested if c not in available]
+        if len(unknown) > 0:
+            raise ValueError("unknown columns: %s" % ','.join(unknown))
+        columns = ['date', 'hour'] + [c for c in requested if c not in ('date', 'hour')]
+    else:
+        columns = [c for c in available if c != 'id']
+    where   = []
+    args    = []
+    # dates are stored as 'YYYY-MM-DD HH:MM:SS' text, which sorts correctly
+    # against a bare 'YYYY-MM-DD', so the (date, hour) index serves the range
+    if 'start' in params:
+        where.append("date >= ?")
+        args.append(parse_day(params['start'][0]))
+    if 'end' in params:
+        where.append("date < ?")
+        args.append(parse_day(params['end'][0]))
+    sql = "SELECT %s FROM %s" % (', '.join(columns), table)
+    if len(where) > 0:
+        sql += " WHERE %s" % ' AND '.join(where)
+    sql += " ORDER BY date, hour"
+    return (sql, args, columns)
+
+def state_etag(state_file, db_path, path):
+    # sizes and mtimes are a cheap version stamp for the whole database: the
+    # state file changes when new rows are inserted, the db file (and its
+    # wal) also when existing rows are rewritten, see derive.py and plan.py
+    stamps = []
+    for f in (state_file, db_path, "%s-wal" % db_path):
+        try:
+            st = os.stat(f)
+            stamps.append("%d:%d" % (st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamps.append("0:0")
+    return '"%s"' % hashlib.sha1(("%s:%s" % (':'.join(stamps), path)).encode('utf-8')).hexdigest()
+
+def encode_ndjson(columns, rows):
+    return ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+def encode_csv(columns, rows):
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerows(rows)
+    return buf.getvalue()
+
+ENCODERS = {
+        'ndjson'    : encode_ndjson,
+        'csv'       : encode_csv,
+        }
+
+# -----------------------------------------------------------------------------
+# Request Handler
+# -----------------------------------------------------------------------------
+def make_handler(logger, resource_name, db_path, state_file, chunk_rows):
+
+    class Handler(BaseHTTPRequestHandler):
+        # chunked transfer encoding needs http/1.1
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):
+            log.debug(logger, {
+                "name"      : __name__,
+                "method"    : "log_message",
+                "src"       : "serve.py",
+                "client"    : self.client_address[0],
+                "message"   : fmt % args,
+                })
+
+        def send_error_text(self, code, message):
+            body = ("%s\n" % message).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def write_chunk(self, s):
+            data = s.encode('utf-8')
+            if len(data) > 0:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+        def do_GET(self):
+            url     = urlparse(self.path)
+            table   = url.path.strip('/')
+            params  = parse_qs(url.query)
+            fmt     = params.get('format', ['ndjson'])[0]
+            if fmt not in FORMATS:
+                return self.send_error_text(400, "unknown format: %s" % fmt)
+            etag = state_etag(state_file, db_path, self.path)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if not os.path.exists(db_path):
+                return self.send_error_text(503, "database not available")
+            conn = connect(db_path)
+            try:
+                try:
+                    (sql, args, columns) = build_query(conn, table, params)
+                    cur = conn.execute(sql, args)
+                except ValueError as e:
+                    return self.send_error_text(400, str(e))
+                except sqlite3.Error:
+                    return self.send_error_text(404, "no data for table: %s" % table)
+                encode = ENCODERS[fmt]
+                self.send_response(200)
+                self.send_header('Content-Type', FORMATS[fmt])
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                if fmt == 'csv':
+                    self.write_chunk(encode(columns, [columns]))
+                rows = cur.fetchmany(chunk_rows)
+                while len(rows) > 0:
+                    self.write_chunk(encode(columns, rows))
+                    rows = cur.fetchmany(chunk_rows)
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                log.debug(logger, {
+                    "name"      : __name__,
+                    "method"    : "do_GET",
+                    "src"       : "serve.py",
+                    "path"      : self.path,
+                    "message"   : "client disconnected",
+                    })
+            finally:
+                conn.close()
+
+    return Handler
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+def run(logger, manifest, config):
+    resource_name   = manifest['name']
+    db_dir          = config['working_dir']
+    state_file      = config['state_file']
+    host            = config['host']
+    port            = config['port']
+    chunk_rows      = config['chunk_rows']
+    db_path         = db_file(resource_name, db_dir)
+    handler = make_handler(logger, resource_name, db_path, state_file, chunk_rows)
+    server  = ThreadingHTTPServer((host, port), handler)
+    log.info(logger, {
+        "name"      : __name__,
+        "method"    : "run",
+        "resource"  : resource_name,
+        "db"        : db_path,
+        "host"      : host,
+        "port"      : port,
+        "message"   : "serving",
+        })
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        loglevel = sys.argv[1]
+    else:
+        loglevel = "INFO"
+    log.configure_logging()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(loglevel)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "main",
+        "src"       : "serve.py"
+        })
+    with open('manifest.json', 'r') as json_file:
+        m = json.load(json_file)
+        c = config()
+        if len(sys.argv) > 2:
+            c['port'] = int(sys.argv[2])
+        run(logger, m, c)